@@ -0,0 +1,123 @@
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+# User fields copied into the tokens, enough to authorize requests without a query
+USER_CLAIMS = ('username', 'is_staff')
+
+
+def add_user_claims(token, user):
+    for name in USER_CLAIMS:
+        token[name] = getattr(user, name)
+    return token
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Issues token pairs carrying USER_CLAIMS"""
+
+    @classmethod
+    def get_token(cls, user):
+        return add_user_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Refreshes access tokens with USER_CLAIMS read from the user row, not
+    copied from the refresh token, so a demoted user loses is_staff at the
+    next refresh. Same checks and rotation as TokenRefreshSerializer.
+    """
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first() if user_id else None
+        if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        # Copied into the access token, and into the refresh token if rotated
+        add_user_claims(refresh, user)
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            # The blacklist app may not be installed
+            if api_settings.BLACKLIST_AFTER_ROTATION and hasattr(refresh, 'blacklist'):
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+        return data
+
+
+class UserCache:
+    """Small in-process cache of users by access token, entries expire after ttl seconds"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            expires, user = self.entries.get(key, (0, None))
+            if expires < time.monotonic():
+                return None
+            return user
+
+    def set(self, key, user):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.entries) >= self.max_size:
+                self.entries = {k: v for k, v in self.entries.items() if v[0] >= now}
+                # Still full of live entries: drop the ones closest to expiring
+                while len(self.entries) >= self.max_size:
+                    del self.entries[min(self.entries, key=lambda k: self.entries[k][0])]
+            self.entries[key] = (now + self.ttl, user)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+user_cache = UserCache(settings.JWT_USER_CACHE_TTL, settings.JWT_USER_CACHE_SIZE)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication trusting the signed claims of the token: the user is
+    built from its id, username and is_staff without touching the database.
+    Tokens issued without the claims are looked up once and then served
+    from `user_cache` for JWT_USER_CACHE_TTL seconds.
+
+    A user deactivated or demoted keeps their claims until their access
+    token expires (ACCESS_TOKEN_LIFETIME), which is the price of skipping
+    the lookup: refreshing reads them from the user row again, see
+    ClaimsTokenRefreshSerializer.
+    """
+
+    def get_user(self, validated_token):
+        claims = (api_settings.USER_ID_CLAIM, *USER_CLAIMS)
+        if all(name in validated_token for name in claims):
+            # simplejwt stores the id as a string
+            id_field = User._meta.get_field(api_settings.USER_ID_FIELD)
+            return User(
+                is_active=True,
+                **{id_field.attname: id_field.to_python(validated_token[api_settings.USER_ID_CLAIM])},
+                **{name: validated_token[name] for name in USER_CLAIMS},
+            )
+
+        key = validated_token.get(api_settings.JTI_CLAIM)
+        user = user_cache.get(key) if key else None
+        if user is None:
+            user = super().get_user(validated_token)
+            if key:
+                user_cache.set(key, user)
+        return user
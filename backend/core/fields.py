@@ -0,0 +1,46 @@
+from django import forms
+from django.db import models
+from . import geo
+
+
+class CoordinatesField(models.BinaryField):
+    """
+    Stores a list of [lat, lng] pairs as packed int32 microdegrees (8 bytes
+    per point) while exposing it to Python as a plain list of floats
+    """
+    description = "List of [lat, lng] pairs stored as packed int32 microdegrees"
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.editable:
+            kwargs.pop('editable', None)
+        else:
+            kwargs['editable'] = False
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return geo.unpack_coordinates(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return geo.unpack_coordinates(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        return geo.pack_coordinates(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def formfield(self, **kwargs):
+        return super(models.BinaryField, self).formfield(
+            **{'form_class': forms.JSONField, **kwargs}
+        )
@@ -0,0 +1,215 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+# Simplification tolerance in meters of each level of detail (0 is the full
+# trace) and the lowest map zoom each level is meant for
+LOD_TOLERANCES_M = {1: 5, 2: 25, 3: 100}
+LOD_MIN_ZOOM = {0: 17, 1: 15, 2: 13, 3: 0}
+
+
+def as_points(coordinates):
+    """Returns the [lat, lng] pairs of a route as an (n, 2) float array"""
+    return np.asarray(coordinates, dtype=float).reshape(-1, 2)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance in km between arrays of points given in degrees"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def path_length_km(coordinates):
+    """Total length in km of the path through all the coordinates"""
+    points = as_points(coordinates)
+    if len(points) < 2:
+        return 0.0
+    lat, lng = points[:, 0], points[:, 1]
+    return float(haversine_km(lat[:-1], lng[:-1], lat[1:], lng[1:]).sum())
+
+
+def simplify(coordinates, tolerance_m):
+    """
+    Douglas-Peucker simplification keeping the first and last points and
+    every point further than tolerance_m meters from the simplified line.
+    Distances are taken on a local equirectangular projection.
+    """
+    points = as_points(coordinates)
+    if len(points) < 3:
+        return points.tolist()
+
+    xy = np.radians(points[:, ::-1]) * EARTH_RADIUS_KM * 1000
+    xy[:, 0] *= np.cos(np.radians(points[:, 0].mean()))
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = xy[end] - xy[start]
+        offsets = xy[start + 1:end] - xy[start]
+        length = np.hypot(dx, dy)
+        if length:
+            distances = np.abs(dx * offsets[:, 1] - dy * offsets[:, 0]) / length
+        else:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.extend([(start, middle), (middle, end)])
+    return points[keep].tolist()
+
+
+def lod_for_zoom(zoom):
+    """The coarsest level of detail that still looks right at a map zoom"""
+    return min(lod for lod, min_zoom in LOD_MIN_ZOOM.items() if zoom >= min_zoom)
+
+
+def bounding_box(coordinates):
+    """Returns (min_lat, min_lng, max_lat, max_lng), all None without points"""
+    points = as_points(coordinates)
+    if not len(points):
+        return None, None, None, None
+    min_lat, min_lng = points.min(axis=0).tolist()
+    max_lat, max_lng = points.max(axis=0).tolist()
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def parse_bbox(value):
+    """
+    Parses a 'minLng,minLat,maxLng,maxLat' string into floats, raising
+    ValueError when it is malformed or out of range
+    """
+    min_lng, min_lat, max_lng, max_lat = (float(part) for part in value.split(','))
+    if not (-180 <= min_lng <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError("Bounding box out of range")
+    return min_lng, min_lat, max_lng, max_lat
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+
+
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    """Encodes a point as a geohash (12 characters is a cell of a few cm)"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def geohash_decode(geohash):
+    """Returns the (lat, lng) center of a geohash cell"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            interval = lng_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def geohash_cell_size(precision):
+    """Returns the (lat, lng) size in degrees of a geohash cell"""
+    bits = 5 * precision
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_neighborhood(lat, lng, precision):
+    """Geohashes of the cell containing the point and of its 8 neighbors"""
+    dlat, dlng = geohash_cell_size(precision)
+    cells = set()
+    for lat_step in (-1, 0, 1):
+        for lng_step in (-1, 0, 1):
+            cell_lat = min(max(lat + lat_step * dlat, -90), 90)
+            cell_lng = (lng + lng_step * dlng + 180) % 360 - 180
+            cells.add(geohash_encode(cell_lat, cell_lng, precision))
+    return cells
+
+
+def geohash_search_radius_km(lat, precision):
+    """
+    Distance from a point that is always covered by its geohash
+    neighborhood: one cell in every direction
+    """
+    dlat, dlng = geohash_cell_size(precision)
+    lat_km = np.radians(dlat) * EARTH_RADIUS_KM
+    lng_km = np.radians(dlng) * EARTH_RADIUS_KM * np.cos(np.radians(min(abs(lat) + dlat, 90)))
+    return float(min(lat_km, lng_km))
+
+
+# Coordinates are quantized to integer microdegrees for compact storage and
+# encoding, which is about 11cm of precision at the equator.
+COORDINATE_PRECISION = 6
+COORDINATE_SCALE = 10 ** COORDINATE_PRECISION
+
+
+def quantize(coordinates):
+    """Returns the coordinates as an (n, 2) int32 array of microdegrees"""
+    return np.round(as_points(coordinates) * COORDINATE_SCALE).astype(np.int32)
+
+
+def pack_coordinates(coordinates):
+    """Packs [lat, lng] pairs into little-endian int32 microdegree bytes"""
+    return quantize(coordinates).astype('<i4').tobytes()
+
+
+def unpack_coordinates(data):
+    """Inverse of `pack_coordinates`, returns a list of [lat, lng] floats"""
+    values = np.frombuffer(bytes(data), dtype='<i4').reshape(-1, 2)
+    return (values / COORDINATE_SCALE).tolist()
+
+
+def encode_polyline(coordinates):
+    """Encodes [lat, lng] pairs as a Google encoded polyline with 1e-6 precision"""
+    deltas = np.diff(quantize(coordinates), axis=0, prepend=[[0, 0]]).ravel()
+    chunks = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def decode_polyline(polyline):
+    """Inverse of `encode_polyline`, returns a list of [lat, lng] floats"""
+    values = []
+    value = shift = 0
+    for char in polyline:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    points = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    return (points / COORDINATE_SCALE).tolist()
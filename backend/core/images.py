@@ -0,0 +1,148 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models.functions import Now
+from PIL import Image, ImageOps
+from . import response_cache
+
+logger = logging.getLogger(__name__)
+
+# Widths in pixels of the resized copies of a route image, never upscaled
+VARIANT_WIDTHS = (320, 640, 1280)
+# Encoding of each variant format: Pillow format, file extension, save options
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def variant_name(name, width, variant_format):
+    """
+    Name a variant is saved as, next to the original: route_images/a.jpg ->
+    route_images/a.w320.webp. ContentAddressedStorage keeps the directory
+    and extension only.
+    """
+    root, _ = os.path.splitext(name)
+    return f'{root}.w{width}.{VARIANT_FORMATS[variant_format][1]}'
+
+
+def resized(image, width):
+    """The image scaled down to width keeping its aspect ratio, or as is if already narrower"""
+    if image.width <= width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def encode_variants(storage, name):
+    """
+    Resizes and encodes an image to the VARIANT_WIDTHS x VARIANT_FORMATS
+    copies, returns {width: {format: (variant_name, encoded bytes)}}
+    """
+    with storage.open(name, 'rb') as original:
+        image = Image.open(original)
+        # Phones store the orientation apart from the pixels
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    opaque = image
+    if has_alpha:
+        # JPEG has no alpha channel, transparent areas go white
+        opaque = Image.new('RGB', image.size, 'white')
+        opaque.paste(image, mask=image.getchannel('A'))
+
+    encoded = {}
+    for width in VARIANT_WIDTHS:
+        encoded[str(width)] = {}
+        for variant_format, (pillow_format, _, options) in VARIANT_FORMATS.items():
+            source = image if variant_format == 'webp' else opaque
+            buffer = io.BytesIO()
+            resized(source, width).save(buffer, pillow_format, **options)
+            encoded[str(width)][variant_format] = (variant_name(name, width, variant_format), buffer.getvalue())
+    return encoded
+
+
+def build_route_variants(route_id, name):
+    """
+    Generates the variants of a route's image and stores them on the route,
+    if it still has that image. Images are shared (see core.storage), the
+    variants of another route with the same image are reused as they are.
+    """
+    from .models import Route, StoredFile
+
+    storage = Route._meta.get_field('image').storage
+    variants = (
+        Route.objects.filter(image=name).exclude(pk=route_id).exclude(image_variants={})
+        .values_list('image_variants', flat=True).first()
+    )
+    encoded = None
+    if variants is None:
+        # Resized outside the transaction, only the writes hold the route lock
+        try:
+            encoded = encode_variants(storage, name)
+        except (OSError, Image.DecompressionBombError):
+            logger.exception("Could not generate the variants of %s", name)
+            return False
+
+    with transaction.atomic():
+        # The image may have been replaced while resizing
+        previous = (
+            Route.objects.select_for_update().filter(pk=route_id, image=name)
+            .values_list('image_variants', flat=True).first()
+        )
+        if previous is None:
+            return False
+        if encoded is None:
+            StoredFile.acquire(Route.stored_file_names(None, variants))
+        else:
+            # Referenced as they are written, see StoredFile.store
+            saved = StoredFile.store(storage, {
+                target: ContentFile(data) for formats in encoded.values() for target, data in formats.values()
+            })
+            variants = {
+                width: {variant_format: saved[target] for variant_format, (target, _) in formats.items()}
+                for width, formats in encoded.items()
+            }
+        Route.objects.filter(pk=route_id, image=name).update(image_variants=variants, updated_at=Now())
+        StoredFile.release(Route.stored_file_names(None, previous))
+        response_cache.bump_catalog_version()
+    return True
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_VARIANT_WORKERS, thread_name_prefix='image-variants'
+            )
+        return _executor
+
+
+def build_in_thread(route_id, name):
+    """build_route_variants for a worker thread, closing its connection afterwards"""
+    try:
+        return build_route_variants(route_id, name)
+    finally:
+        # The worker thread's own connection
+        connection.close()
+
+
+def schedule_variants(route_id, name):
+    """
+    Generates the variants of a route image off the request path, in a pool
+    of IMAGE_VARIANT_WORKERS threads, or right away with no workers
+    """
+    if not settings.IMAGE_VARIANT_WORKERS:
+        return build_route_variants(route_id, name)
+    return executor().submit(build_in_thread, route_id, name)
@@ -0,0 +1,50 @@
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Now
+from core import response_cache
+from core.models import Route, StoredFile
+from core.storage import is_addressed
+
+
+class Command(BaseCommand):
+    help = (
+        "Move route images stored under their upload names to content-addressed names, "
+        "merging identical files. Run backfill_image_variants afterwards."
+    )
+
+    def handle(self, *args, **options):
+        storage = Route._meta.get_field("image").storage
+        names = (
+            Route.objects.exclude(image="").exclude(image__isnull=True)
+            .order_by("image").values_list("image", flat=True).distinct()
+        )
+        moved = 0
+        for name in names.iterator():
+            if is_addressed(name):
+                continue
+            try:
+                with storage.open(name, "rb") as original, transaction.atomic():
+                    routes = Route.objects.select_for_update().filter(image=name)
+                    route_variants = list(routes.values_list("image_variants", flat=True))
+                    addressed = StoredFile.store(storage, {name: original}, count=len(route_variants))[name]
+                    # Variants are regenerated under content-addressed names
+                    # too, the current ones lose a reference per route
+                    released = Counter(
+                        variant for image_variants in route_variants
+                        for variant in Route.stored_file_names(None, image_variants)
+                    )
+                    for variant, count in released.items():
+                        StoredFile.release([variant], count)
+                    routes.update(image=addressed, image_variants={}, updated_at=Now())
+            except OSError as error:
+                self.stdout.write(f"Skipped {name}: {error}")
+                continue
+
+            moved += len(route_variants)
+            # The original stays, seed_data and older clients may still refer to it
+            self.stdout.write(f"{name} -> {addressed} ({len(route_variants)} routes)")
+
+        if moved:
+            response_cache.bump_catalog_version()
+        self.stdout.write(f"Content-addressed images for {moved} routes.")
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from core import images
+from core.models import Route
+
+
+class Command(BaseCommand):
+    help = "Generate the resized variants of route images uploaded before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of images resized at once, 0 resizes them one by one in this thread",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Number of routes loaded per batch",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Regenerate the variants of every image, not only the ones missing them",
+        )
+
+    def handle(self, *args, **options):
+        routes = Route.objects.exclude(image="").exclude(image__isnull=True)
+        if not options["all"]:
+            routes = routes.filter(image_variants={})
+
+        workers = options["workers"]
+        pool = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        last_id = 0
+        generated = 0
+        failed = 0
+        try:
+            while True:
+                chunk = list(
+                    routes.filter(id__gt=last_id).order_by("id").values_list("id", "image")[:options["chunk_size"]]
+                )
+                if not chunk:
+                    break
+
+                if pool:
+                    results = list(pool.map(images.build_in_thread, *zip(*chunk)))
+                else:
+                    results = [images.build_route_variants(route_id, name) for route_id, name in chunk]
+                generated += sum(results)
+                failed += len(results) - sum(results)
+
+                last_id = chunk[-1][0]
+                self.stdout.write(f"Processed {generated + failed} routes...")
+        finally:
+            if pool:
+                pool.shutdown()
+
+        self.stdout.write(f"Image variants generated for {generated} routes, {failed} failed.")
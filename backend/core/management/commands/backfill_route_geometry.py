@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from core import response_cache
+from core.models import Route
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute the columns derived from Route.coordinates for existing routes missing them, "
+        "in chunks. Use --all to recompute every route."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of routes loaded and updated per batch",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute the geometry of every route, not only of those missing it",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        fields = ["id", "coordinates", *Route.GEOMETRY_FIELDS]
+        routes = Route.objects.all()
+        if not options["all"]:
+            # Routes with coordinates saved before a derived column existed
+            routes = routes.exclude(coordinates=b"").filter(
+                Q(min_lat__isnull=True) | Q(start_geohash="") | Q(coordinates_lod1=b"")
+            )
+        last_id = 0
+        total = 0
+
+        while True:
+            chunk = list(routes.filter(id__gt=last_id).order_by("id").only(*fields)[:chunk_size])
+            if not chunk:
+                break
+
+            previous_geohashes = [route.start_geohash for route in chunk]
+            for route in chunk:
+                route.sync_geometry()
+            Route.objects.bulk_update(chunk, Route.GEOMETRY_FIELDS)
+            # bulk_update skips Route.save, which drops the tiles showing the routes
+            Route.invalidate_tiles(*previous_geohashes, *(route.start_geohash for route in chunk))
+
+            last_id = chunk[-1].id
+            total += len(chunk)
+            self.stdout.write(f"Updated {total} routes...")
+
+        if total:
+            response_cache.bump_catalog_version()
+        self.stdout.write(f"Route geometry backfilled for {total} routes.")
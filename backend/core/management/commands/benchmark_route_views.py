@@ -0,0 +1,81 @@
+import random
+import statistics
+import time
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+from core import view_buffer
+from core.models import Route
+from core.views import RouteViewSet
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = (
+        "Time a burst of add_to_history requests written one by one and through the "
+        "view buffer, counting database writes. Everything is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--views", type=int, default=1000, help="Number of requests in the burst")
+        parser.add_argument("--users", type=int, default=50, help="Number of users viewing routes")
+        parser.add_argument("--routes", type=int, default=200, help="Number of routes viewed")
+        parser.add_argument("--buffer-size", type=int, default=200, help="Buffer size of the buffered run")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            users, routes = self.create_data(options["users"], options["routes"])
+            pick = random.Random(0).choice
+            burst = [(pick(users), pick(routes).id) for _ in range(options["views"])]
+            for label, buffer_size in (("direct", 1), ("buffered", options["buffer_size"])):
+                with override_settings(ROUTE_VIEW_BUFFER_SIZE=buffer_size, ROUTE_VIEW_FLUSH_INTERVAL=None):
+                    self.run(label, burst)
+            transaction.set_rollback(True)
+
+    def create_data(self, user_count, route_count):
+        users = [User.objects.create(username=f"benchmark-user-{i}") for i in range(user_count)]
+        routes = Route.objects.bulk_create([
+            Route(
+                user=users[0],
+                title=f"Benchmark Route {i}",
+                description="Benchmark",
+                starting_location="Start",
+                ending_location="End",
+                coordinates=[[0.001 * i, 0.0], [0.001 * i, 0.001]],
+            )
+            for i in range(route_count)
+        ])
+        return users, routes
+
+    def run(self, label, burst):
+        factory = APIRequestFactory()
+        view = RouteViewSet.as_view({"post": "add_to_history"})
+        latencies = []
+        statements = []
+
+        def count(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            for user, route_id in burst:
+                request = factory.post(f"/api/routes/{route_id}/add_to_history/")
+                force_authenticate(request, user=user)
+                start = time.perf_counter()
+                response = view(request, pk=route_id)
+                latencies.append((time.perf_counter() - start) * 1000)
+                assert response.status_code == 200, response.data
+            flush_start = time.perf_counter()
+            view_buffer.buffer.flush()
+            flush_ms = (time.perf_counter() - flush_start) * 1000
+
+        writes = sum(sql.lstrip().upper().startswith(WRITE_STATEMENTS) for sql in statements)
+        p95 = statistics.quantiles(latencies, n=20)[-1]
+        self.stdout.write(
+            f"{label:>8}: {len(burst)} views, request mean {statistics.mean(latencies):.3f} ms, "
+            f"p95 {p95:.3f} ms, max {max(latencies):.3f} ms, {writes} write statements, "
+            f"{len(statements)} queries, final flush {flush_ms:.1f} ms"
+        )
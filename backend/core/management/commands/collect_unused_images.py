@@ -0,0 +1,87 @@
+import os
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from core.models import Route, StoredFile
+from core.storage import is_addressed
+
+
+class Command(BaseCommand):
+    help = "Delete the content-addressed route images and variants no route has used for a while"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-hours",
+            type=float,
+            default=24,
+            help="Hours a file must have gone unreferenced before it is deleted",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Recompute the reference counts from the routes first",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only list the files that would be deleted",
+        )
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            changed = StoredFile.rebuild_references()
+            self.stdout.write(f"Reference counts rebuilt, {changed} corrected.")
+
+        storage = Route._meta.get_field("image").storage
+        cutoff = timezone.now() - timedelta(hours=options["grace_hours"])
+        orphans = self.register_orphans(storage, options["dry_run"])
+        if orphans:
+            verb = "Found" if options["dry_run"] else "Registered"
+            self.stdout.write(f"{verb} {len(orphans)} files without a reference count.")
+
+        unused = StoredFile.objects.filter(references__lte=0, updated_at__lt=cutoff)
+        deleted = 0
+        for pk, name in unused.values_list("pk", "name").iterator(chunk_size=500):
+            if options["dry_run"]:
+                self.stdout.write(name)
+                continue
+            with transaction.atomic():
+                # Re-checked under the row lock: a StoredFile.store of the same
+                # content either took its reference first or waits for the
+                # file to be gone and writes it again
+                if not unused.select_for_update().filter(pk=pk).exists():
+                    continue
+                storage.delete(name)
+                StoredFile.objects.filter(pk=pk).delete()
+            deleted += 1
+
+        self.stdout.write(f"Deleted {deleted} unused files.")
+
+    def register_orphans(self, storage, dry_run):
+        """
+        Gives a StoredFile row to the content-addressed files that have none,
+        written by saves whose transaction rolled back, so they are collected
+        like the others once their grace period has passed. Returns their names.
+        """
+        directory = Route._meta.get_field("image").upload_to
+        if not storage.exists(directory):
+            return []
+        names = {os.path.join(directory, file_name) for file_name in storage.listdir(directory)[1] if is_addressed(file_name)}
+        orphans = names - set(StoredFile.objects.values_list("name", flat=True).iterator(chunk_size=2000))
+        if dry_run or not orphans:
+            return sorted(orphans)
+
+        # Files a route uses anyway keep their references
+        counts = dict.fromkeys(orphans, 0)
+        routes = Route.objects.exclude(image="").exclude(image__isnull=True).values_list("image", "image_variants")
+        for image, image_variants in routes.iterator(chunk_size=2000):
+            for name in Route.stored_file_names(image, image_variants) & orphans:
+                counts[name] += 1
+        # A save still writing one of them has its row: the insert waits for
+        # it and then skips the name
+        StoredFile.objects.bulk_create(
+            [StoredFile(name=name, references=references) for name, references in counts.items()],
+            ignore_conflicts=True,
+        )
+        return sorted(orphans)
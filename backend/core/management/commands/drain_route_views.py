@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from core import view_buffer
+
+
+class Command(BaseCommand):
+    help = "Write the route views spooled by processes that could not flush them on shutdown"
+
+    def handle(self, *args, **options):
+        written = view_buffer.drain_spool()
+        self.stdout.write(f"Drained {written} route views.")
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from core import route_export
+from core.serializers import requested_lod
+from core.views import RouteViewSet
+
+# Query parameters of RouteViewSet.get_queryset, as options
+FILTERS = ("search", "user", "order_by", "tags", "tags_mode", "bbox", "from", "to", "lod")
+
+
+class Command(BaseCommand):
+    help = "Stream every route, optionally filtered like the route list, as GeoJSON or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format",
+            choices=route_export.EXPORT_FORMATS,
+            default="geojson",
+            help="GeoJSON FeatureCollection or newline-delimited JSON",
+        )
+        parser.add_argument("--output", help="File to write, standard output by default")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=route_export.EXPORT_CHUNK_SIZE,
+            help="Number of routes read from the database at a time",
+        )
+        for name in FILTERS:
+            parser.add_argument(f"--{name.replace('_', '-')}", dest=name, help=f"Same as the ?{name}= list filter")
+
+    def handle(self, *args, **options):
+        params = {name: options[name] for name in FILTERS if options[name] is not None}
+        # Filter through the viewset so the export matches /api/routes/export/
+        request = Request(RequestFactory().get("/", params))
+        try:
+            queryset = RouteViewSet(request=request, action="export").get_queryset()
+            lod = requested_lod(request)
+        except ValidationError as error:
+            raise CommandError(error.detail)
+
+        exported = 0
+
+        def counted(records):
+            nonlocal exported
+            for record in records:
+                exported += 1
+                yield record
+
+        records = route_export.route_records(queryset, lod=lod, chunk_size=options["chunk_size"])
+        chunks = route_export.iter_export(counted(records), options["format"])
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as output:
+                output.writelines(chunks)
+            self.stdout.write(f"Exported {exported} routes to {options['output']}.")
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
@@ -0,0 +1,49 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from core.route_import import DEFAULT_BATCH_SIZE, RouteImporter, RouteImportError
+
+
+class Command(BaseCommand):
+    help = "Import routes from GeoJSON FeatureCollection or GPX files, streaming them in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="GeoJSON or GPX files to import")
+        parser.add_argument(
+            "--user",
+            required=True,
+            help="Username of the owner of the imported routes",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Number of routes inserted per batch",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["geojson", "gpx"],
+            help="Format of the files, detected from their content by default",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['user']} does not exist.")
+
+        importer = RouteImporter(user, batch_size=options["batch_size"])
+        for path in options["paths"]:
+            created = importer.created
+            try:
+                with open(path, "rb") as route_file:
+                    importer.import_file(route_file, options["format"])
+            except (OSError, RouteImportError) as error:
+                raise CommandError(f"{path}: {error} ({importer.created} routes imported so far)")
+            self.stdout.write(f"{path}: {importer.created - created} routes imported.")
+
+        for error in importer.errors:
+            self.stdout.write(error)
+        self.stdout.write(
+            f"Imported {importer.created} routes, skipped {importer.duplicates} duplicates "
+            f"and {importer.invalid} invalid routes."
+        )
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from core import response_cache
+from core.models import Route
+
+
+class Command(BaseCommand):
+    help = "Rebuild the denormalized vote counters of every route from the vote tables"
+
+    def handle(self, *args, **kwargs):
+        updated = Route.rebuild_vote_counts()
+        response_cache.bump_catalog_version()
+        self.stdout.write(f"Vote counters rebuilt for {updated} routes.")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from core import response_cache
+
+
+class Command(BaseCommand):
+    help = "Report the hit and miss counts of the route list response cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Reset the counters after reporting them",
+        )
+
+    def handle(self, *args, **options):
+        stats = response_cache.stats()
+        self.stdout.write(
+            f"Route list cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"hit ratio {stats['hit_ratio']:.1%} (catalog version {response_cache.catalog_version()})."
+        )
+        if options["reset"]:
+            response_cache.reset_stats()
+            self.stdout.write("Counters reset.")
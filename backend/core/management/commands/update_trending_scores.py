@@ -0,0 +1,44 @@
+from django.db.models import Max
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+from core import response_cache
+from core.models import Route, TrendingEpoch
+
+
+class Command(BaseCommand):
+    help = "Recompute the trending score of the routes voted on since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of routes recomputed per batch",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute every route with votes, not only the ones voted on since the last run",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        started = timezone.now()
+
+        half_lives = TrendingEpoch.rebase(started)
+        if half_lives:
+            self.stdout.write(f"Trending epoch moved {half_lives} half-lives forward.")
+
+        routes = Route.objects.filter(votes_changed_at__isnull=False)
+        last_run = Route.objects.aggregate(last_run=Max("trending_computed_at"))["last_run"]
+        if last_run and not options["all"]:
+            routes = routes.filter(votes_changed_at__gte=last_run)
+
+        route_ids = list(routes.order_by("id").values_list("id", flat=True))
+        total = 0
+        for start in range(0, len(route_ids), chunk_size):
+            total += Route.rebuild_trending_scores(route_ids[start:start + chunk_size], started)
+            self.stdout.write(f"Updated {total} routes...")
+
+        response_cache.bump_catalog_version()
+        self.stdout.write(f"Trending scores updated for {total} routes.")
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:19
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_vote_counts(apps, schema_editor):
+    Route = apps.get_model('core', 'Route')
+
+    def count_for(through):
+        return Coalesce(
+            Subquery(
+                through.objects.filter(route_id=OuterRef('pk'))
+                .order_by()
+                .values('route_id')
+                .annotate(total=Count('*'))
+                .values('total')
+            ),
+            Value(0),
+        )
+
+    upvotes = count_for(Route.upvotes.through)
+    downvotes = count_for(Route.downvotes.through)
+    Route.objects.update(
+        upvotes_count=upvotes,
+        downvotes_count=downvotes,
+        net_votes=upvotes - downvotes,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_alter_route_ending_location_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='downvotes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='net_votes',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='upvotes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_vote_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_route_vote_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='distance',
+            field=models.FloatField(db_index=True, default=0, help_text='Total length of the route in kilometers'),
+        ),
+    ]
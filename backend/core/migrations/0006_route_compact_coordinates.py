@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:24
+
+import core.fields
+from django.db import migrations
+
+
+def pack_coordinates(apps, schema_editor):
+    Route = apps.get_model('core', 'Route')
+    routes = Route.objects.only('id', 'coordinates').order_by('id')
+    batch = []
+    for route in routes.iterator(chunk_size=500):
+        route.packed_coordinates = route.coordinates or []
+        batch.append(route)
+        if len(batch) == 500:
+            Route.objects.bulk_update(batch, ['packed_coordinates'])
+            batch = []
+    Route.objects.bulk_update(batch, ['packed_coordinates'])
+
+
+def unpack_coordinates(apps, schema_editor):
+    Route = apps.get_model('core', 'Route')
+    routes = Route.objects.only('id', 'packed_coordinates').order_by('id')
+    batch = []
+    for route in routes.iterator(chunk_size=500):
+        route.coordinates = route.packed_coordinates or []
+        batch.append(route)
+        if len(batch) == 500:
+            Route.objects.bulk_update(batch, ['coordinates'])
+            batch = []
+    Route.objects.bulk_update(batch, ['coordinates'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_route_distance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='packed_coordinates',
+            field=core.fields.CoordinatesField(default=list),
+        ),
+        migrations.RunPython(pack_coordinates, unpack_coordinates),
+        migrations.RemoveField(
+            model_name='route',
+            name='coordinates',
+        ),
+        migrations.RenameField(
+            model_name='route',
+            old_name='packed_coordinates',
+            new_name='coordinates',
+        ),
+        migrations.AlterField(
+            model_name='route',
+            name='coordinates',
+            field=core.fields.CoordinatesField(default=list, help_text='Array of geographic coordinates defining the route path'),
+        ),
+    ]
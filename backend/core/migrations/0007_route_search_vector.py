@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:27
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import UnaccentExtension
+from django.db import migrations
+
+CREATE_SEARCH_SQL = """
+CREATE TEXT SEARCH CONFIGURATION public.portuguese_unaccent (COPY = pg_catalog.portuguese);
+ALTER TEXT SEARCH CONFIGURATION public.portuguese_unaccent
+    ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem;
+
+CREATE FUNCTION core_route_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('public.portuguese_unaccent', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('public.portuguese_unaccent',
+            coalesce(NEW.starting_location, '') || ' ' || coalesce(NEW.ending_location, '')), 'B') ||
+        setweight(to_tsvector('public.portuguese_unaccent', CASE
+            WHEN jsonb_typeof(NEW.tags) = 'array' THEN coalesce(
+                (SELECT string_agg(tag, ' ') FROM jsonb_array_elements_text(NEW.tags) AS tag), '')
+            ELSE '' END), 'C') ||
+        setweight(to_tsvector('public.portuguese_unaccent', coalesce(NEW.description, '')), 'D');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_route_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description, starting_location, ending_location, tags
+    ON core_route
+    FOR EACH ROW EXECUTE FUNCTION core_route_search_vector_update();
+
+CREATE INDEX core_route_search_vector_gin ON core_route USING gin (search_vector);
+
+UPDATE core_route SET title = title;
+"""
+
+DROP_SEARCH_SQL = """
+DROP INDEX IF EXISTS core_route_search_vector_gin;
+DROP TRIGGER IF EXISTS core_route_search_vector_trigger ON core_route;
+DROP FUNCTION IF EXISTS core_route_search_vector_update();
+DROP TEXT SEARCH CONFIGURATION IF EXISTS public.portuguese_unaccent;
+"""
+
+
+def create_search(apps, schema_editor):
+    # The tsvector trigger and GIN index only exist on PostgreSQL; other
+    # databases keep the column NULL and search with substring matching.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SEARCH_SQL)
+
+
+def drop_search(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_route_compact_coordinates'),
+    ]
+
+    operations = [
+        UnaccentExtension(),
+        migrations.AddField(
+            model_name='route',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search, drop_search),
+    ]
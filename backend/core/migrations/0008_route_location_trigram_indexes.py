@@ -0,0 +1,35 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+CREATE_INDEXES_SQL = """
+CREATE INDEX core_route_starting_location_trgm ON core_route USING gin (starting_location gin_trgm_ops);
+CREATE INDEX core_route_ending_location_trgm ON core_route USING gin (ending_location gin_trgm_ops);
+"""
+
+DROP_INDEXES_SQL = """
+DROP INDEX IF EXISTS core_route_starting_location_trgm;
+DROP INDEX IF EXISTS core_route_ending_location_trgm;
+"""
+
+
+def create_indexes(apps, schema_editor):
+    # Trigram indexes only exist on PostgreSQL, see core.search.location_search
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_INDEXES_SQL)
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_INDEXES_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_route_search_vector'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
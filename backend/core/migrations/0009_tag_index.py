@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def index_existing_tags(apps, schema_editor):
+    Route = apps.get_model('core', 'Route')
+    Tag = apps.get_model('core', 'Tag')
+    RouteTag = apps.get_model('core', 'RouteTag')
+
+    names_by_route = {}
+    for route_id, tags in Route.objects.values_list('id', 'tags').iterator(chunk_size=1000):
+        if isinstance(tags, list):
+            names_by_route[route_id] = {
+                tag.strip().lower()[:50] for tag in tags if isinstance(tag, str) and tag.strip()
+            }
+
+    all_names = set().union(*names_by_route.values())
+    Tag.objects.bulk_create([Tag(name=name) for name in all_names], ignore_conflicts=True)
+    tag_ids = dict(Tag.objects.values_list('name', 'id'))
+    RouteTag.objects.bulk_create(
+        [
+            RouteTag(route_id=route_id, tag_id=tag_ids[name])
+            for route_id, names in names_by_route.items()
+            for name in names
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_route_location_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RouteTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='route_tags', to='core.route')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='route_tags', to='core.tag')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='tag_set',
+            field=models.ManyToManyField(blank=True, related_name='routes', through='core.RouteTag', to='core.tag'),
+        ),
+        migrations.AddIndex(
+            model_name='routetag',
+            index=models.Index(fields=['tag', 'route'], name='core_routetag_tag_route_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='routetag',
+            constraint=models.UniqueConstraint(fields=('route', 'tag'), name='unique_route_tag'),
+        ),
+        migrations.RunPython(index_existing_tags, migrations.RunPython.noop),
+    ]
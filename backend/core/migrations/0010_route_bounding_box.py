@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_tag_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='max_lat',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='max_lng',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='min_lat',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='min_lng',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_route_bounding_box'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='start_geohash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=12),
+        ),
+    ]
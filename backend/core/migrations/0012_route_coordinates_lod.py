@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:41
+
+import core.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_route_start_geohash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='coordinates_lod1',
+            field=core.fields.CoordinatesField(default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='coordinates_lod2',
+            field=core.fields.CoordinatesField(default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='coordinates_lod3',
+            field=core.fields.CoordinatesField(default=list, editable=False),
+        ),
+    ]
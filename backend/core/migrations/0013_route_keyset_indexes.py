@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_route_coordinates_lod'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='route',
+            index=models.Index(fields=['created_at', 'id'], name='core_route_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='route',
+            index=models.Index(fields=['net_votes', 'created_at', 'id'], name='core_route_liked_idx'),
+        ),
+    ]
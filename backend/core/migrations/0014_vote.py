@@ -0,0 +1,111 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:52
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+# Frozen copies of Vote.TRENDING_* at the time of this migration
+TRENDING_WEIGHTS = {1: 3, -1: -2}
+TRENDING_HALF_LIFE = timedelta(days=7)
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def copy_votes(apps, schema_editor):
+    Route = apps.get_model('core', 'Route')
+    Vote = apps.get_model('core', 'Vote')
+    now = django.utils.timezone.now()
+
+    # Upvotes first so they win over a downvote by the same user
+    for through, value in ((Route.upvotes.through, 1), (Route.downvotes.through, -1)):
+        rows = through.objects.values_list('route_id', 'user_id').iterator(chunk_size=1000)
+        batch = []
+        for route_id, user_id in rows:
+            batch.append(Vote(route_id=route_id, user_id=user_id, value=value, created_at=now))
+            if len(batch) >= 1000:
+                Vote.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        Vote.objects.bulk_create(batch, ignore_conflicts=True)
+
+    def count_for(value):
+        return Coalesce(
+            Subquery(
+                Vote.objects.filter(route_id=OuterRef('pk'), value=value)
+                .order_by()
+                .values('route_id')
+                .annotate(total=Count('*'))
+                .values('total')
+            ),
+            Value(0),
+        )
+
+    upvotes = count_for(1)
+    downvotes = count_for(-1)
+    Route.objects.update(
+        upvotes_count=upvotes,
+        downvotes_count=downvotes,
+        net_votes=upvotes - downvotes,
+    )
+
+    # Every copied vote gets the same timestamp, so the score is linear in the counts
+    scale = 2 ** ((now - TRENDING_EPOCH) / TRENDING_HALF_LIFE)
+    Route.objects.filter(models.Q(upvotes_count__gt=0) | models.Q(downvotes_count__gt=0)).update(
+        trending_score=(
+            models.F('upvotes_count') * TRENDING_WEIGHTS[1]
+            + models.F('downvotes_count') * TRENDING_WEIGHTS[-1]
+        ) * scale,
+        votes_changed_at=now,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_route_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='trending_computed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='trending_score',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='votes_changed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='Vote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.SmallIntegerField(choices=[(1, 'upvote'), (-1, 'downvote')])),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='votes', to='core.route')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='votes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['route', 'value'], name='core_vote_route_value_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'route'), name='unique_user_route_vote')],
+            },
+        ),
+        migrations.RunPython(copy_votes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='route',
+            name='downvotes',
+        ),
+        migrations.RemoveField(
+            model_name='route',
+            name='upvotes',
+        ),
+    ]
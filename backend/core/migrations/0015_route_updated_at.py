@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:03
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_updated_at(apps, schema_editor):
+    Route = apps.get_model('core', 'Route')
+    Route.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_vote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+    ]
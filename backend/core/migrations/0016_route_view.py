@@ -0,0 +1,77 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.utils.dateparse import parse_datetime
+
+# RouteView.HISTORY_LIMIT at the time of this migration
+HISTORY_LIMIT = 50
+
+
+def copy_route_history(apps, schema_editor):
+    UserDetails = apps.get_model('core', 'UserDetails')
+    RouteView = apps.get_model('core', 'RouteView')
+    now = django.utils.timezone.now()
+
+    for details in UserDetails.objects.exclude(route_history=[]).iterator(chunk_size=500):
+        views = {}
+        for entry in details.route_history[:HISTORY_LIMIT]:
+            if not isinstance(entry, dict) or not isinstance(entry.get('route_id'), int):
+                continue
+            try:
+                viewed_at = parse_datetime(entry.get('viewed_at') or '') or now
+            except ValueError:
+                viewed_at = now
+            # Entries are most recent first, keep the first one per route
+            views.setdefault(entry['route_id'], RouteView(
+                user_id=details.user_id,
+                route_id=entry['route_id'],
+                title=entry.get('title'),
+                viewed_at=viewed_at,
+            ))
+        RouteView.objects.bulk_create(views.values(), ignore_conflicts=True)
+
+
+def copy_route_views_back(apps, schema_editor):
+    UserDetails = apps.get_model('core', 'UserDetails')
+    RouteView = apps.get_model('core', 'RouteView')
+
+    for details in UserDetails.objects.iterator(chunk_size=500):
+        views = RouteView.objects.filter(user_id=details.user_id).order_by('-viewed_at', '-id')
+        details.route_history = [
+            {"route_id": view.route_id, "viewed_at": view.viewed_at.isoformat(), "title": view.title}
+            for view in views[:HISTORY_LIMIT]
+        ]
+        details.save(update_fields=['route_history'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_route_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteView',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=255, null=True)),
+                ('viewed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('route', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.route')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='route_views', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'viewed_at'], name='core_routeview_user_viewed_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'route'), name='unique_user_route_view')],
+            },
+        ),
+        migrations.RunPython(copy_route_history, copy_route_views_back),
+        migrations.RemoveField(
+            model_name='userdetails',
+            name='route_history',
+        ),
+    ]
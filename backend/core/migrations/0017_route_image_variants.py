@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_route_view'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:50
+
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_route_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('references', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='route',
+            name='image',
+            field=models.ImageField(blank=True, help_text='An image representing this route', null=True, storage=core.storage.route_image_storage, upload_to='route_images/'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:06
+
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import migrations, models
+
+# Frozen copy of Vote.TRENDING_EPOCH, the scale of the scores stored so far
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def create_epoch(apps, schema_editor):
+    TrendingEpoch = apps.get_model('core', 'TrendingEpoch')
+    TrendingEpoch.objects.get_or_create(pk=1, defaults={'epoch': TRENDING_EPOCH})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_stored_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingEpoch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoch', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_epoch, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,18 @@
-import math
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value, Window
+from django.db.models.fields.files import FieldFile
+from django.db.models.functions import Coalesce, Now, RowNumber
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, MaxValueValidator
 from typing import List
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
+from . import geo, images, response_cache, tiles
+from .fields import CoordinatesField
+from .storage import is_addressed, route_image_storage
 
 class Route(models.Model):
     id = models.AutoField(primary_key=True)
@@ -22,8 +29,8 @@ class Route(models.Model):
     starting_location = models.CharField(max_length=255)
     ending_location = models.CharField(max_length=255)
     
-    # Store coordinates as a JSON array of [lat, lng] pairs
-    coordinates = models.JSONField(
+    # Store coordinates as packed int32 microdegree [lat, lng] pairs
+    coordinates = CoordinatesField(
         help_text="Array of geographic coordinates defining the route path",
         default=list
     )
@@ -37,30 +44,169 @@ class Route(models.Model):
     
     image = models.ImageField(
         upload_to='route_images/',
+        storage=route_image_storage,
         blank=True,
         null=True,
         help_text="An image representing this route"
     )
+    # Resized copies of the image, {width: {format: storage name}}, filled
+    # in the background after each upload, see core.images
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
+    # Moved by every change to the route's representation, votes included
+    updated_at = models.DateTimeField(auto_now=True)
 
-    upvotes = models.ManyToManyField(
-        User,
-        related_name="upvoted_routes",
-        blank=True,
-        help_text="Users that upvoted this route"
+    # Denormalized vote counters, moved by `cast_vote` together with the
+    # Vote rows. Use `rebuild_vote_counts` to recompute them.
+    upvotes_count = models.PositiveIntegerField(default=0)
+    downvotes_count = models.PositiveIntegerField(default=0)
+    net_votes = models.IntegerField(default=0, db_index=True)
+
+    # Sum of the votes' trending weights, see `Vote.trending_weight`
+    trending_score = models.FloatField(default=0, db_index=True)
+    votes_changed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    trending_computed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # Derived from the coordinates on save, see `sync_geometry`
+    distance = models.FloatField(
+        default=0,
+        db_index=True,
+        help_text="Total length of the route in kilometers"
     )
-    
-    downvotes = models.ManyToManyField(
-        User,
-        related_name="downvoted_routes",
-        blank=True,
-        help_text="Users that downvoted this route"
+
+    # Bounding box of the coordinates, NULL for routes without coordinates
+    min_lat = models.FloatField(null=True, blank=True, db_index=True)
+    min_lng = models.FloatField(null=True, blank=True, db_index=True)
+    max_lat = models.FloatField(null=True, blank=True, db_index=True)
+    max_lng = models.FloatField(null=True, blank=True, db_index=True)
+
+    # Geohash of the start point, its prefixes index the nearby search
+    start_geohash = models.CharField(max_length=12, blank=True, default='', db_index=True)
+
+    # Douglas-Peucker simplified coordinates, see geo.LOD_TOLERANCES_M
+    coordinates_lod1 = CoordinatesField(default=list, editable=False)
+    coordinates_lod2 = CoordinatesField(default=list, editable=False)
+    coordinates_lod3 = CoordinatesField(default=list, editable=False)
+
+    GEOMETRY_FIELDS = [
+        'distance', 'min_lat', 'min_lng', 'max_lat', 'max_lng', 'start_geohash',
+        'coordinates_lod1', 'coordinates_lod2', 'coordinates_lod3',
+    ]
+
+    # Normalized copy of `tags`, kept in sync on save (see `sync_tag_index`)
+    tag_set = models.ManyToManyField(
+        'Tag',
+        through='RouteTag',
+        related_name='routes',
+        blank=True
     )
 
+    # Weighted full-text document, maintained by a PostgreSQL trigger and
+    # indexed with GIN (see migration 0007). Always NULL on other databases.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination on the default and liked orderings
+            models.Index(fields=['created_at', 'id'], name='core_route_created_idx'),
+            models.Index(fields=['net_votes', 'created_at', 'id'], name='core_route_liked_idx'),
+        ]
 
     def __str__(self):
         return self.title
+
+    @classmethod
+    def rebuild_vote_counts(cls, queryset=None):
+        """Recompute the vote counters from the Vote table in a single UPDATE"""
+        if queryset is None:
+            queryset = cls.objects.all()
+
+        def count_for(value):
+            return Coalesce(
+                Subquery(
+                    Vote.objects.filter(route_id=OuterRef('pk'), value=value)
+                    .order_by()
+                    .values('route_id')
+                    .annotate(total=Count('*'))
+                    .values('total')
+                ),
+                Value(0),
+            )
+
+        upvotes = count_for(Vote.UP)
+        downvotes = count_for(Vote.DOWN)
+        return queryset.update(
+            upvotes_count=upvotes,
+            downvotes_count=downvotes,
+            net_votes=upvotes - downvotes,
+            updated_at=Now(),
+        )
+
+    @classmethod
+    def rebuild_trending_scores(cls, route_ids, computed_at):
+        """Recompute the trending score of the given routes from their votes"""
+        scores = dict.fromkeys(route_ids, 0.0)
+        with transaction.atomic():
+            # Holds off a rebase, which would rescale the other scores meanwhile
+            epoch = TrendingEpoch.current(lock=True)
+            votes = Vote.objects.filter(route_id__in=scores).values_list('route_id', 'value', 'created_at')
+            for route_id, value, created_at in votes.iterator():
+                scores[route_id] += Vote.trending_weight(value, created_at, epoch)
+            cls.objects.bulk_update(
+                [cls(pk=pk, trending_score=score, trending_computed_at=computed_at) for pk, score in scores.items()],
+                ['trending_score', 'trending_computed_at'],
+            )
+        return len(scores)
+
+    def cast_vote(self, user, value, toggle=False):
+        """
+        Sets the user's vote on this route to Vote.UP, Vote.DOWN or None
+        (no vote) and moves the counters and trending score by the difference.
+        With toggle, casting the vote the user already has takes it back.
+        Returns the user's vote afterwards.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            # Writing the route row first takes its lock (the database lock
+            # on SQLite), so concurrent votes on the route, e.g. a double tap
+            # from two devices, run one after the other and each one sees
+            # the vote left by the previous one
+            Route.objects.filter(pk=self.pk).update(votes_changed_at=now)
+            previous = Vote.objects.filter(route=self, user=user).values_list('value', 'created_at').first()
+            previous_value, previous_created_at = previous or (None, None)
+            if toggle and previous_value == value:
+                value = None
+            if previous_value == value:
+                return value
+
+            if value is None:
+                Vote.objects.filter(route=self, user=user).delete()
+            else:
+                Vote.objects.bulk_create(
+                    [Vote(route=self, user=user, value=value, created_at=now)],
+                    update_conflicts=True,
+                    unique_fields=['user', 'route'],
+                    update_fields=['value', 'created_at'],
+                )
+
+            upvote_delta = (value == Vote.UP) - (previous_value == Vote.UP)
+            downvote_delta = (value == Vote.DOWN) - (previous_value == Vote.DOWN)
+            # Read after locking the route, a rebase rescaling it has committed by then
+            epoch = TrendingEpoch.current()
+            trending_delta = (
+                Vote.trending_weight(value, now, epoch)
+                - Vote.trending_weight(previous_value, previous_created_at, epoch)
+            )
+            Route.objects.filter(pk=self.pk).update(
+                upvotes_count=F('upvotes_count') + upvote_delta,
+                downvotes_count=F('downvotes_count') + downvote_delta,
+                net_votes=F('net_votes') + upvote_delta - downvote_delta,
+                trending_score=F('trending_score') + trending_delta,
+                updated_at=now,
+            )
+            response_cache.bump_catalog_version()
+        return value
     
     @property
     def start_point(self):
@@ -76,32 +222,240 @@ class Route(models.Model):
             return self.coordinates[-1]
         return None
     
-    @property
-    def distance(self):
-        """Calculate the total distance of the route in kilometers"""
-        if not self.coordinates or len(self.coordinates) < 2:
-            return 0
-            
-        def haversine(point1, point2):
-            """Calculate distance between two lat/lng points in km"""
-            lat1, lng1 = point1
-            lat2, lng2 = point2
-            
-            # Convert decimal degrees to radians
-            lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
-            
-            # Haversine formula for distance on a sphere
-            dlat = lat2 - lat1
-            dlng = lng2 - lng1
-            a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlng/2)**2
-            c = 2 * math.asin(math.sqrt(a))
-            r = 6371  # Radius of earth in kilometers
-            return c * r
-        
-        total = 0
-        for i in range(len(self.coordinates)-1):
-            total += haversine(self.coordinates[i], self.coordinates[i+1])
-        return total
+    def sync_geometry(self):
+        """Recompute the columns derived from the coordinates"""
+        self.distance = geo.path_length_km(self.coordinates)
+        self.min_lat, self.min_lng, self.max_lat, self.max_lng = geo.bounding_box(self.coordinates)
+        start = self.start_point
+        self.start_geohash = geo.geohash_encode(*start) if start else ''
+        for lod, tolerance in geo.LOD_TOLERANCES_M.items():
+            setattr(self, self.geometry_field(lod), geo.simplify(self.coordinates, tolerance))
+
+    @staticmethod
+    def geometry_field(lod):
+        """Name of the column holding the coordinates at a level of detail"""
+        return f'coordinates_lod{lod}' if lod else 'coordinates'
+
+    # Fields whose changes are detected on save to refresh derived data
+    TRACKED_FIELDS = ('coordinates', 'tags', 'image')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            name: instance.tracked_value(name) for name in cls.TRACKED_FIELDS if name in field_names
+        }
+        return instance
+
+    def tracked_value(self, field_name):
+        value = getattr(self, field_name)
+        # Files are compared by name, the FieldFile itself changes in place on save
+        return value.name if isinstance(value, FieldFile) else value
+
+    def has_changed(self, field_name):
+        """Whether a tracked field differs from the value loaded from the database"""
+        if field_name in self.get_deferred_fields():
+            return False
+        if self._state.adding:
+            return True
+        loaded_values = getattr(self, '_loaded_values', {})
+        return field_name not in loaded_values or self.tracked_value(field_name) != loaded_values[field_name]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        changed = {
+            name for name in self.TRACKED_FIELDS
+            if self.has_changed(name) and (update_fields is None or name in update_fields)
+        }
+        previous_geohash = '' if self._state.adding else self.start_geohash
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'updated_at'}
+        if 'coordinates' in changed:
+            self.sync_geometry()
+            if update_fields is not None:
+                kwargs['update_fields'] |= set(self.GEOMETRY_FIELDS)
+        if 'image' in changed:
+            # The variants of the previous image no longer apply
+            self.image_variants = {}
+            if update_fields is not None:
+                kwargs['update_fields'].add('image_variants')
+        with transaction.atomic():
+            if 'image' in changed:
+                self.save_image_references()
+            super().save(*args, **kwargs)
+        if 'tags' in changed:
+            Route.sync_tag_index([self])
+        if 'image' in changed and self.image:
+            route_id, name = self.pk, self.image.name
+            transaction.on_commit(lambda: images.schedule_variants(route_id, name))
+        self.invalidate_tiles(previous_geohash, self.start_geohash)
+        self._loaded_values = {
+            name: self.tracked_value(name)
+            for name in self.TRACKED_FIELDS if name not in self.get_deferred_fields()
+        }
+
+    def save_image_references(self):
+        """
+        Writes a newly uploaded image and moves the stored file references
+        from the previous image and its variants to it, in the transaction
+        of the save
+        """
+        previous_files = None
+        if not self._state.adding:
+            previous_files = Route.objects.filter(pk=self.pk).values_list('image', 'image_variants').first()
+        image = self.image
+        if image and not image._committed:
+            # Saved here instead of by the field so it is referenced before it is written
+            name = image.field.generate_filename(self, image.name)
+            image.name = StoredFile.store(image.storage, {name: image.file}, max_length=image.field.max_length)[name]
+            image._committed = True
+        else:
+            StoredFile.acquire([image.name])
+        # The new file is acquired first, it may be the previous one
+        if previous_files:
+            StoredFile.release(self.stored_file_names(*previous_files))
+
+    @staticmethod
+    def stored_file_names(image, image_variants):
+        """Names of the stored files a route uses: its image and the image's variants"""
+        names = {name for formats in (image_variants or {}).values() for name in formats.values()}
+        if image:
+            names.add(image)
+        return names
+
+    @staticmethod
+    def invalidate_tiles(*start_geohashes):
+        """Drops the cached map tiles showing any of the given start points"""
+        tiles.invalidate_tiles(geo.geohash_decode(geohash) for geohash in set(start_geohashes) if geohash)
+
+    @classmethod
+    def sync_tag_index(cls, routes):
+        """Rebuild the RouteTag rows of the given routes from their `tags` lists"""
+        names_by_route = {route.pk: Tag.normalize_names(route.tags) for route in routes}
+        all_names = set().union(*names_by_route.values())
+
+        with transaction.atomic():
+            Tag.objects.bulk_create([Tag(name=name) for name in all_names], ignore_conflicts=True)
+            tag_ids = dict(Tag.objects.filter(name__in=all_names).values_list('name', 'id'))
+            RouteTag.objects.filter(route_id__in=names_by_route).delete()
+            RouteTag.objects.bulk_create([
+                RouteTag(route_id=route_id, tag_id=tag_ids[name])
+                for route_id, names in names_by_route.items()
+                for name in names
+            ])
+
+class Vote(models.Model):
+    """A user's up or down vote on a route, at most one per user and route"""
+    UP = 1
+    DOWN = -1
+    VALUE_CHOICES = [(UP, 'upvote'), (DOWN, 'downvote')]
+
+    # Trending score: each vote weighs TRENDING_WEIGHTS[value] when cast and
+    # halves every TRENDING_HALF_LIFE. Weights are stored scaled to an epoch
+    # (growing instead of decaying), which keeps the order of the routes
+    # right without rescoring the routes that got no new votes. The epoch
+    # starts at TRENDING_EPOCH and is moved forward by TrendingEpoch.rebase
+    # before the weights grow out of float range.
+    TRENDING_WEIGHTS = {UP: 3, DOWN: -2}
+    TRENDING_HALF_LIFE = timedelta(days=7)
+    TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='votes')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='votes')
+    value = models.SmallIntegerField(choices=VALUE_CHOICES)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'route'], name='unique_user_route_vote'),
+        ]
+        indexes = [
+            models.Index(fields=['route', 'value'], name='core_vote_route_value_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.get_value_display()} {self.route}"
+
+    @classmethod
+    def trending_weight(cls, value, created_at, epoch=None):
+        """Trending weight of a vote, scaled to the epoch (TrendingEpoch.current() by default)"""
+        if value is None:
+            return 0.0
+        if epoch is None:
+            epoch = TrendingEpoch.current()
+        age = (created_at - epoch) / cls.TRENDING_HALF_LIFE
+        return cls.TRENDING_WEIGHTS[value] * 2 ** age
+
+class TrendingEpoch(models.Model):
+    """
+    The time the stored trending scores are scaled to, a single row. The
+    weights double every half-life after it, `rebase` moves it forward and
+    rescales the scores before they overflow or lose precision.
+    """
+    # Half-lives after the epoch before `rebase` moves it, weights stay below 2^(REBASE_AFTER + 2)
+    REBASE_AFTER = 52
+
+    epoch = models.DateTimeField()
+
+    def __str__(self):
+        return self.epoch.isoformat()
+
+    @classmethod
+    def current(cls, lock=False):
+        """The epoch of the stored scores, lock keeps it until the transaction ends"""
+        rows = cls.objects.select_for_update() if lock else cls.objects
+        epoch = rows.filter(pk=1).values_list('epoch', flat=True).first()
+        return epoch or Vote.TRENDING_EPOCH
+
+    @classmethod
+    def rebase(cls, now=None):
+        """
+        Moves the epoch forward by whole half-lives once REBASE_AFTER have
+        passed, halving the scores as many times in the same transaction.
+        Returns the number of half-lives moved.
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            cls.objects.get_or_create(pk=1, defaults={'epoch': Vote.TRENDING_EPOCH})
+            epoch = cls.current(lock=True)
+            half_lives = int((now - epoch) / Vote.TRENDING_HALF_LIFE)
+            if half_lives < cls.REBASE_AFTER:
+                return 0
+            # Votes cast meanwhile lock their route first and wait for the
+            # rescaled score, or computed their weight in the old epoch and
+            # get rescaled with it. A power of two rescales exactly.
+            Route.objects.exclude(trending_score=0).update(trending_score=F('trending_score') * 2.0 ** -half_lives)
+            cls.objects.filter(pk=1).update(epoch=epoch + half_lives * Vote.TRENDING_HALF_LIFE)
+        return half_lives
+
+class Tag(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def normalize_names(tags):
+        """Returns the set of normalized tag names in a list of tags"""
+        if not isinstance(tags, list):
+            return set()
+        return {
+            tag.strip().lower()[:50]
+            for tag in tags if isinstance(tag, str) and tag.strip()
+        }
+
+class RouteTag(models.Model):
+    """Indexed route-tag association, mirrors `Route.tags`"""
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='route_tags')
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name='route_tags')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['route', 'tag'], name='unique_route_tag'),
+        ]
+        indexes = [
+            models.Index(fields=['tag', 'route'], name='core_routetag_tag_route_idx'),
+        ]
 
 class UserDetails(models.Model):
     user = models.OneToOneField(
@@ -109,44 +463,173 @@ class UserDetails(models.Model):
         on_delete=models.CASCADE,
         related_name='details'
     )
-    # Store route history as a JSONField
-    route_history = models.JSONField(
-        default=list,
-        blank=True,
-        help_text="List of recently viewed routes with timestamps"
-    )
     
     def __str__(self):
         return f"{self.user.username}'s details"
     
     def add_to_history(self, route_id, route_title=None):
         """Add a route to the user's history"""
-        
-        entry = {
-            "route_id": route_id,
-            "viewed_at": timezone.now().isoformat(),
-            "title": route_title
-        }
-        
-        history = list(self.route_history)
-        history = [item for item in history if item.get('route_id') != route_id] # Remove if already exists
-        history.insert(0, entry) # Add to beginning
-        
-        # Limit to 50 entries
-        if len(history) > 50:
-            history = history[:50]
-        
-        self.route_history = history
-        self.save(update_fields=['route_history'])
-        
-        return history
+        RouteView.record(self.user_id, route_id, route_title)
 
     def get_history(self, limit=None):
-        """Get user's route history, optionally limited"""
-        history = self.route_history
+        """Get user's route history, most recent first, optionally limited"""
+        views = RouteView.objects.filter(user_id=self.user_id).order_by('-viewed_at', '-id')
         if limit and isinstance(limit, int):
-            return history[:limit]
-        return history
+            views = views[:limit]
+        return [view.as_entry() for view in views]
+
+class RouteView(models.Model):
+    """
+    Last time a user viewed a route, one row per user and route. Viewing
+    again moves viewed_at forward; only the HISTORY_LIMIT most recent
+    views of each user are kept.
+    """
+    HISTORY_LIMIT = 50
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='route_views')
+    # No database constraint: views of deleted routes stay in the history with their title
+    route = models.ForeignKey(
+        Route, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+'
+    )
+    title = models.CharField(max_length=255, blank=True, null=True)
+    viewed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'route'], name='unique_user_route_view'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'viewed_at'], name='core_routeview_user_viewed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} viewed {self.route_id} at {self.viewed_at}"
+
+    def as_entry(self):
+        """The history entry of this view, as returned by UserDetails.get_history"""
+        return {"route_id": self.route_id, "viewed_at": self.viewed_at.isoformat(), "title": self.title}
+
+    @classmethod
+    def record(cls, user_id, route_id, title=None, viewed_at=None):
+        """Upserts the user's view of a route and prunes the history beyond HISTORY_LIMIT"""
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, route_id=route_id, title=title, viewed_at=viewed_at or timezone.now())],
+            update_conflicts=True,
+            unique_fields=['user', 'route'],
+            update_fields=['title', 'viewed_at'],
+        )
+        cls.prune([user_id])
+
+    @classmethod
+    def record_many(cls, views, batch_size=500):
+        """
+        Upserts (user_id, route_id, title, viewed_at) views in batches and
+        prunes the histories they touched. The latest view of a route wins
+        and views of deleted users are dropped. Returns the views written.
+        """
+        latest = {}
+        for user_id, route_id, title, viewed_at in views:
+            key = (user_id, route_id)
+            if key not in latest or latest[key].viewed_at < viewed_at:
+                latest[key] = cls(user_id=user_id, route_id=route_id, title=title, viewed_at=viewed_at)
+        users = set(User.objects.filter(id__in={user_id for user_id, _ in latest}).values_list('id', flat=True))
+        rows = [view for view in latest.values() if view.user_id in users]
+
+        with transaction.atomic():
+            cls.objects.bulk_create(
+                rows,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['user', 'route'],
+                update_fields=['title', 'viewed_at'],
+            )
+            cls.prune(users)
+        return len(rows)
+
+    @classmethod
+    def prune(cls, user_ids):
+        """
+        Deletes the views of the given users older than their HISTORY_LIMIT
+        most recent ones, in one statement ranking each user's views
+        """
+        ranked = cls.objects.filter(user_id__in=user_ids).annotate(
+            rank=Window(RowNumber(), partition_by=F('user_id'), order_by=[F('viewed_at').desc(), F('id').desc()])
+        ).filter(rank__gt=cls.HISTORY_LIMIT)
+        return cls.objects.filter(id__in=ranked.values('id')).delete()[0]
+
+class StoredFile(models.Model):
+    """
+    Reference count of a content-addressed file (see core.storage), the
+    number of routes using it as their image or one of its variants.
+    Files left without references are deleted by `collect_unused_images`
+    after a grace period, so a file uploaded again in the meantime stays.
+    Use `rebuild_references` to recompute the counts from the routes.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    references = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references})"
+
+    @classmethod
+    def acquire(cls, names, count=1):
+        """Adds count references to each content-addressed file in names"""
+        names = {name for name in names if is_addressed(name)}
+        if not names:
+            return
+        cls.objects.bulk_create([cls(name=name) for name in names], ignore_conflicts=True)
+        acquired = cls.objects.filter(name__in=names).update(references=F('references') + count, updated_at=Now())
+        if acquired < len(names):
+            # Rows deleted by collect_unused_images in between, along with their files
+            missing = names - set(cls.objects.filter(name__in=names).values_list('name', flat=True))
+            cls.objects.bulk_create([cls(name=name, references=count) for name in missing], ignore_conflicts=True)
+
+    @classmethod
+    def release(cls, names, count=1):
+        """Takes count references from each content-addressed file in names"""
+        names = {name for name in names if is_addressed(name)}
+        if names:
+            cls.objects.filter(name__in=names).update(references=F('references') - count, updated_at=Now())
+
+    @classmethod
+    def store(cls, storage, files, count=1, max_length=None):
+        """
+        Saves {name: content} to the storage with count references to each
+        file, returning {name: saved name}. Call it in a transaction: the
+        references are taken first, so collect_unused_images, which
+        re-checks them under the row lock, either sees them or has deleted
+        the file before it is saved. Files of a transaction that rolls back
+        are left without a row until collect_unused_images registers them.
+        """
+        content_name = getattr(storage, 'content_name', None)
+        if content_name is not None:
+            # Identical contents are one file, referenced once
+            cls.acquire({content_name(name, content) for name, content in files.items()}, count)
+        return {name: storage.save(name, content, max_length=max_length) for name, content in files.items()}
+
+    @classmethod
+    def rebuild_references(cls):
+        """Recomputes every count from the routes' images and variants"""
+        counts = {}
+        routes = Route.objects.exclude(image='').exclude(image__isnull=True).values_list('image', 'image_variants')
+        for image, image_variants in routes.iterator(chunk_size=2000):
+            for name in Route.stored_file_names(image, image_variants):
+                if is_addressed(name):
+                    counts[name] = counts.get(name, 0) + 1
+
+        now = timezone.now()
+        with transaction.atomic():
+            cls.objects.bulk_create([cls(name=name) for name in counts], ignore_conflicts=True, batch_size=1000)
+            changed = []
+            for stored in cls.objects.only('id', 'name', 'references').iterator(chunk_size=2000):
+                references = counts.get(stored.name, 0)
+                if stored.references != references:
+                    # Counts set to 0 get a full grace period too
+                    stored.references, stored.updated_at = references, now
+                    changed.append(stored)
+            cls.objects.bulk_update(changed, ['references', 'updated_at'], batch_size=1000)
+        return len(changed)
 
 @receiver(post_save, sender=User)
 def create_user_details(sender, instance, created, **kwargs):
@@ -155,4 +638,20 @@ def create_user_details(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_details(sender, instance, **kwargs):
-    instance.details.save()
\ No newline at end of file
+    # Details never loaded through this user, e.g. on the last_login
+    # update of a login, have no changes to save
+    if User.details.is_cached(instance):
+        instance.details.save()
+
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+def bump_route_catalog_version(sender, **kwargs):
+    response_cache.bump_catalog_version()
+
+@receiver(post_delete, sender=Route)
+def invalidate_deleted_route_tiles(sender, instance, **kwargs):
+    instance.invalidate_tiles(instance.start_geohash)
+
+@receiver(post_delete, sender=Route)
+def release_deleted_route_files(sender, instance, **kwargs):
+    StoredFile.release(Route.stored_file_names(instance.image.name, instance.image_variants))
@@ -0,0 +1,106 @@
+import base64
+import binascii
+import json
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset (cursor) pagination over the queryset's own ordering,
+    with the primary key appended as a tie-breaker. Each page is a range
+    condition on the ordering keys of the last row sent, so there is no
+    COUNT(*) and no OFFSET however deep the page is.
+
+    Pass an empty ?cursor= for the first page and follow `next` afterwards.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.keys = self.get_ordering_keys(queryset)
+        queryset = queryset.order_by(*(f'-{name}' if desc else name for name, desc in self.keys))
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.after(self.decode_cursor(cursor, queryset.model)))
+
+        page = list(queryset[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_ordering_keys(self, queryset):
+        """[(name, descending)] of the queryset ordering, ending with the pk"""
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        keys = []
+        for field in ordering:
+            if not isinstance(field, str):
+                raise TypeError('KeysetPagination only supports ordering by field or annotation names')
+            name = field.lstrip('-')
+            keys.append(('id' if name == 'pk' else name, field.startswith('-')))
+        if 'id' not in {name for name, _ in keys}:
+            descending = keys[-1][1] if keys else False
+            keys.append(('id', descending))
+        return keys
+
+    def after(self, values):
+        """Rows that come after the given ordering key values"""
+        condition = Q()
+        equal = Q()
+        for (name, desc), value in zip(self.keys, values):
+            condition |= equal & Q(**{f'{name}__{"lt" if desc else "gt"}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        values = [getattr(last, name) for name, _ in self.keys]
+        # Full isoformat, DjangoJSONEncoder would truncate to milliseconds
+        cursor = json.dumps(values, default=lambda value: value.isoformat(), separators=(',', ':'))
+        encoded = base64.urlsafe_b64encode(cursor.encode()).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, cursor, model):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                raise ValueError(cursor)
+            return [self.to_python(model, name, value) for (name, _), value in zip(self.keys, values)]
+        except (ValueError, TypeError, binascii.Error, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def to_python(self, model, name, value):
+        try:
+            return model._meta.get_field(name).to_python(value)
+        except FieldDoesNotExist:
+            # Annotations such as scores are plain numbers
+            if not isinstance(value, (int, float)):
+                raise ValueError(value)
+            return value
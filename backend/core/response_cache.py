@@ -0,0 +1,82 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+from django.core.cache import cache, caches
+from django.db import transaction
+
+# Query parameters that change the route list response, anything else is ignored
+LIST_PARAMS = (
+    'search', 'user', 'order_by', 'page', 'cursor', 'tags', 'tags_mode',
+    'bbox', 'from', 'to', 'lod', 'zoom', 'geometry', 'image_size',
+)
+LIST_CACHE_TIMEOUT = 10 * 60
+CATALOG_VERSION_KEY = 'route-catalog:version'
+HITS_KEY = 'route-list-cache:hits'
+MISSES_KEY = 'route-list-cache:misses'
+
+
+def catalog_version():
+    """
+    Current version of the route catalog, cached responses of older versions
+    are stale. Versions are the time of the change in nanoseconds, so one
+    never repeats. Kept in the 'catalog' cache, which never evicts it.
+    """
+    return caches['catalog'].get_or_set(CATALOG_VERSION_KEY, time.time_ns, timeout=None)
+
+
+def catalog_modified(version):
+    """Time of the change that started a catalog version"""
+    return datetime.fromtimestamp(version / 1e9, tz=timezone.utc)
+
+
+def bump_catalog_version():
+    """Invalidates every cached list response, once the current transaction commits"""
+    transaction.on_commit(_bump_catalog_version)
+
+
+def _bump_catalog_version():
+    caches['catalog'].set(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def list_cache_key(request, version):
+    """
+    Cache key of a route list request: the catalog version plus its known
+    query parameters, sorted so reordered URLs share the entry
+    """
+    params = sorted(
+        (name, value)
+        for name in LIST_PARAMS
+        for value in request.query_params.getlist(name)
+    )
+    normalized = '&'.join(f'{name}={value}' for name, value in params)
+    # The host is part of the key since pagination links are absolute URLs
+    digest = hashlib.sha1(f'{request.get_host()}?{normalized}'.encode()).hexdigest()
+    return f'route-list:{version}:{digest}'
+
+
+def _count(key):
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def record_hit():
+    _count(HITS_KEY)
+
+
+def record_miss():
+    _count(MISSES_KEY)
+
+
+def stats():
+    """Returns the hits, misses and hit ratio of the route list cache"""
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_ratio': hits / total if total else 0.0}
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,194 @@
+import io
+from xml.sax.saxutils import XMLGenerator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer
+from .models import Route
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = ('geojson', 'ndjson')
+# Single route downloads, see render_route_file
+ROUTE_FILE_TYPES = {
+    'gpx': 'application/gpx+xml',
+    'kml': 'application/vnd.google-earth.kml+xml',
+}
+ROUTE_FILE_CACHE_TIMEOUT = 24 * 60 * 60
+# RouteSerializer fields minus the ones derived per request
+EXPORT_FIELDS = (
+    'id', 'user', 'title', 'description', 'starting_location', 'ending_location',
+    'tags', 'created_at', 'updated_at', 'distance', 'image',
+    'upvotes_count', 'downvotes_count', 'net_votes',
+)
+
+encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    Registers an export format with DRF so ?format= selects it. Exports are
+    streamed by the view, only error responses are rendered here.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return encoder.encode(data).encode()
+
+
+class GeoJSONRenderer(ExportRenderer):
+    media_type = 'application/geo+json'
+    format = 'geojson'
+
+
+class NDJSONRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class ExportContentNegotiation(DefaultContentNegotiation):
+    """
+    Picks the export format from ?format= or the Accept header. Exports
+    are files, a client accepting neither format (e.g. Accept:
+    application/json) gets the one asked with ?format=, or GeoJSON.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            export_format = format_suffix or request.query_params.get(self.settings.URL_FORMAT_OVERRIDE)
+            if export_format:
+                renderers = self.filter_renderers(renderers, export_format)
+            return renderers[0], renderers[0].media_type
+
+
+def route_records(queryset, lod=0, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields every route of the queryset as a dict, reading chunk_size rows
+    at a time (with a server-side cursor on PostgreSQL) and without
+    building model instances
+    """
+    image_storage = Route._meta.get_field('image').storage
+    geometry_field = Route.geometry_field(lod)
+    rows = queryset.values(
+        *EXPORT_FIELDS, geometry_field, username=F('user__username'),
+    ).iterator(chunk_size=chunk_size)
+    for record in rows:
+        record['coordinates'] = record.pop(geometry_field)
+        if record['image']:
+            record['image'] = image_storage.url(record['image'])
+        yield record
+
+
+def route_feature(record):
+    """A route record as a GeoJSON Feature, positions being [lng, lat]"""
+    coordinates = record.pop('coordinates')
+    positions = [[lng, lat] for lat, lng in coordinates]
+    if len(positions) > 1:
+        geometry = {'type': 'LineString', 'coordinates': positions}
+    elif positions:
+        geometry = {'type': 'Point', 'coordinates': positions[0]}
+    else:
+        geometry = None
+    return {'type': 'Feature', 'id': record['id'], 'properties': record, 'geometry': geometry}
+
+
+def batched(lines, size):
+    """Joins lines into strings of size lines, sparing a write per route"""
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def iter_ndjson(records, batch_size=100):
+    """Newline-delimited JSON, one route per line"""
+    return batched((encoder.encode(record) + '\n' for record in records), batch_size)
+
+
+def iter_geojson(records, batch_size=100):
+    """A GeoJSON FeatureCollection, written one feature at a time"""
+    yield '{"type":"FeatureCollection","features":['
+    features = (
+        (',' if index else '') + encoder.encode(route_feature(record))
+        for index, record in enumerate(records)
+    )
+    yield from batched(features, batch_size)
+    yield ']}\n'
+
+
+def iter_export(records, export_format):
+    """Chunks of the export of the records in one of EXPORT_FORMATS"""
+    if export_format == 'ndjson':
+        return iter_ndjson(records)
+    return iter_geojson(records)
+
+
+def text_element(writer, name, text, attrs=None):
+    writer.startElement(name, attrs or {})
+    writer.characters(text)
+    writer.endElement(name)
+
+
+def write_gpx(writer, route):
+    """A GPX 1.1 document with the route as a single-segment track"""
+    writer.startElement('gpx', {
+        'version': '1.1',
+        'creator': 'mc656-project',
+        'xmlns': 'http://www.topografix.com/GPX/1/1',
+    })
+    writer.startElement('metadata', {})
+    text_element(writer, 'name', route.title)
+    text_element(writer, 'time', route.updated_at.isoformat())
+    writer.endElement('metadata')
+    writer.startElement('trk', {})
+    text_element(writer, 'name', route.title)
+    if route.description:
+        text_element(writer, 'desc', route.description)
+    writer.startElement('trkseg', {})
+    for lat, lng in route.coordinates:
+        writer.startElement('trkpt', {'lat': f'{lat:.6f}', 'lon': f'{lng:.6f}'})
+        writer.endElement('trkpt')
+    writer.endElement('trkseg')
+    writer.endElement('trk')
+    writer.endElement('gpx')
+
+
+def write_kml(writer, route):
+    """A KML 2.2 document with the route as a LineString placemark"""
+    writer.startElement('kml', {'xmlns': 'http://www.opengis.net/kml/2.2'})
+    writer.startElement('Document', {})
+    text_element(writer, 'name', route.title)
+    writer.startElement('Placemark', {})
+    text_element(writer, 'name', route.title)
+    if route.description:
+        text_element(writer, 'description', route.description)
+    writer.startElement('LineString', {})
+    text_element(writer, 'tessellate', '1')
+    writer.startElement('coordinates', {})
+    # KML tuples are lng,lat separated by spaces
+    for lat, lng in route.coordinates:
+        writer.characters(f'{lng:.6f},{lat:.6f} ')
+    writer.endElement('coordinates')
+    writer.endElement('LineString')
+    writer.endElement('Placemark')
+    writer.endElement('Document')
+    writer.endElement('kml')
+
+
+def render_route_file(route, file_format):
+    """
+    The route as a GPX or KML document (see ROUTE_FILE_TYPES), written
+    element by element with a SAX writer instead of building a tree
+    """
+    out = io.BytesIO()
+    writer = XMLGenerator(out, encoding='utf-8', short_empty_elements=True)
+    writer.startDocument()
+    (write_gpx if file_format == 'gpx' else write_kml)(writer, route)
+    writer.endDocument()
+    return out.getvalue()
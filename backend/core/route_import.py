@@ -0,0 +1,345 @@
+import codecs
+import json
+import math
+from xml.etree import ElementTree
+from django.db import transaction
+from . import response_cache
+from .models import Route, Tag
+
+READ_CHUNK_SIZE = 64 * 1024
+# Largest single feature accepted from a GeoJSON file, bounds the memory
+# used by a malformed or truncated feature
+MAX_FEATURE_SIZE = 16 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 1000
+# Errors kept in the import report, the rest are only counted
+MAX_REPORTED_ERRORS = 50
+
+
+class RouteImportError(ValueError):
+    """A file or a route in it that cannot be imported"""
+
+
+class JSONReader:
+    """
+    Pull parser for a JSON document read in chunks from a binary or text
+    stream. Containers are walked token by token, values are decoded whole,
+    so only the value being decoded is held in memory.
+    """
+
+    def __init__(self, stream, chunk_size=READ_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Appends the next chunk to the buffer, returns False at the end of the stream"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        text = chunk if isinstance(chunk, str) else self.decoder.decode(chunk, final=not chunk)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-blank character without consuming it, '' at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, *chars):
+        """Consumes the next character, which must be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise RouteImportError(f"Invalid JSON: expected {' or '.join(chars)}, found {char or 'the end of the file'}.")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decodes and consumes the next complete value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                if not self.more():
+                    raise RouteImportError(f"Invalid JSON: {error.msg}.")
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if end < len(self.buffer) or not self.more():
+                self.pos = end
+                return value
+
+    def more(self):
+        """Reads another chunk for an incomplete value"""
+        if len(self.buffer) - self.pos > MAX_FEATURE_SIZE:
+            raise RouteImportError("Invalid JSON: a value is larger than the import limit.")
+        return self.fill()
+
+
+def iter_geojson(stream, chunk_size=READ_CHUNK_SIZE):
+    """Yields the features of a GeoJSON FeatureCollection one at a time"""
+    reader = JSONReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',', ']') == ']':
+                        break
+        elif key == 'type':
+            kind = reader.value()
+            if kind != 'FeatureCollection':
+                raise RouteImportError(f"Expected a FeatureCollection, found {kind}.")
+        else:
+            reader.value()
+        if reader.expect(',', '}') == '}':
+            return
+
+
+def feature_fields(feature):
+    """Route fields of a GeoJSON LineString or MultiLineString feature"""
+    if not isinstance(feature, dict) or not isinstance(feature.get('geometry'), dict):
+        raise RouteImportError("Not a feature with a geometry.")
+    geometry = feature['geometry']
+    if geometry.get('type') == 'LineString':
+        lines = [geometry.get('coordinates')]
+    elif geometry.get('type') == 'MultiLineString':
+        lines = geometry.get('coordinates')
+    else:
+        raise RouteImportError(f"Unsupported geometry type {geometry.get('type')}.")
+    if not isinstance(lines, list) or not all(isinstance(line, list) for line in lines):
+        raise RouteImportError("Invalid geometry coordinates.")
+
+    # GeoJSON positions are [lng, lat] or [lng, lat, elevation]
+    coordinates = []
+    for line in lines:
+        for position in line:
+            if not isinstance(position, list) or len(position) < 2:
+                raise RouteImportError("Each position must be a [lng, lat] pair.")
+            coordinates.append([position[1], position[0]])
+
+    properties = feature.get('properties') or {}
+    if not isinstance(properties, dict):
+        raise RouteImportError("Feature properties must be an object.")
+    return {
+        'title': properties.get('title', properties.get('name')),
+        'description': properties.get('description', properties.get('desc', '')),
+        'starting_location': properties.get('starting_location', ''),
+        'ending_location': properties.get('ending_location', ''),
+        'tags': properties.get('tags', []),
+        'coordinates': coordinates,
+    }
+
+
+def local_name(element):
+    """Tag of an XML element without its namespace"""
+    return element.tag.rpartition('}')[2]
+
+
+def gpx_fields(element):
+    """Route fields of a GPX track (trk) or route (rte) element"""
+    # Points have their own name and desc, only the element's children count
+    children = {local_name(child): child.text for child in element}
+    coordinates = []
+    for point in element.iter():
+        if local_name(point) in ('trkpt', 'rtept'):
+            try:
+                coordinates.append([float(point.get('lat')), float(point.get('lon'))])
+            except (TypeError, ValueError):
+                raise RouteImportError("Each point must have numeric lat and lon attributes.")
+    return {
+        'title': children.get('name'),
+        'description': children.get('desc') or '',
+        'coordinates': coordinates,
+    }
+
+
+def iter_gpx(stream):
+    """
+    Yields the fields of each track and route of a GPX file, or the
+    RouteImportError making it invalid. Parsed elements are dropped once
+    read, so memory holds one track at a time.
+    """
+    root = None
+    try:
+        for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+            if root is None:
+                root = element
+                if local_name(root) != 'gpx':
+                    raise RouteImportError(f"Expected a gpx document, found {local_name(root)}.")
+            if event != 'end' or local_name(element) not in ('trk', 'rte', 'wpt'):
+                continue
+            if local_name(element) != 'wpt':
+                try:
+                    yield gpx_fields(element)
+                except RouteImportError as error:
+                    yield error
+            root.clear()
+    except ElementTree.ParseError as error:
+        raise RouteImportError(f"Invalid GPX: {error}.")
+
+
+def detect_format(stream):
+    """'gpx' or 'geojson' from the first character of a seekable stream"""
+    head = stream.read(512)
+    stream.seek(0)
+    if isinstance(head, bytes):
+        head = head.decode('utf-8', errors='ignore')
+    head = head.lstrip('\ufeff \t\r\n')
+    if head.startswith('<'):
+        return 'gpx'
+    if head.startswith('{'):
+        return 'geojson'
+    raise RouteImportError("Unrecognized file, expected a GeoJSON FeatureCollection or a GPX file.")
+
+
+def iter_route_fields(stream, file_format=None):
+    """Yields the route fields of each route in the file, or the RouteImportError making it invalid"""
+    file_format = file_format or detect_format(stream)
+    if file_format == 'gpx':
+        yield from iter_gpx(stream)
+        return
+    for feature in iter_geojson(stream):
+        try:
+            yield feature_fields(feature)
+        except RouteImportError as error:
+            yield error
+
+
+def clean_text(value, name, max_length=None, required=False):
+    if value is None:
+        value = ''
+    if not isinstance(value, str):
+        raise RouteImportError(f"{name} must be a string.")
+    value = value.strip()
+    if required and not value:
+        raise RouteImportError(f"Missing {name}.")
+    if max_length and len(value) > max_length:
+        raise RouteImportError(f"{name} can have at most {max_length} characters.")
+    return value
+
+
+def clean_route_fields(fields):
+    """
+    Validates imported route fields the way RouteSerializer does, returning
+    them normalized. Routes need a title and at least two points.
+    """
+    coordinates = []
+    for point in fields['coordinates']:
+        if not all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in point):
+            raise RouteImportError("Each coordinate must be a pair of numbers.")
+        lat, lng = map(float, point)
+        if not (math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180):
+            raise RouteImportError("Coordinates out of range.")
+        coordinates.append([lat, lng])
+    if len(coordinates) < 2:
+        raise RouteImportError("A route needs at least two points.")
+
+    tags = fields.get('tags') or []
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise RouteImportError("Tags must be a list of strings.")
+    if any(len(tag.strip()) > 50 for tag in tags):
+        raise RouteImportError("Tags can have at most 50 characters.")
+
+    return {
+        'title': clean_text(fields.get('title'), 'title', 255, required=True),
+        'description': clean_text(fields.get('description'), 'description'),
+        'starting_location': clean_text(fields.get('starting_location'), 'starting_location', 255),
+        'ending_location': clean_text(fields.get('ending_location'), 'ending_location', 255),
+        'tags': tags,
+        'coordinates': coordinates,
+    }
+
+
+class RouteImporter:
+    """
+    Imports routes for a user from GeoJSON or GPX files, inserting them
+    with bulk_create in batches of batch_size. A route is a duplicate if
+    the user already has a route with its title (the key seed_data uses),
+    in the database or earlier in the file, and is skipped.
+    """
+
+    def __init__(self, user, batch_size=DEFAULT_BATCH_SIZE):
+        self.user = user
+        self.batch_size = batch_size
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+        self.seen_titles = set()
+        self.batch = []
+
+    def report(self):
+        return {
+            'created': self.created,
+            'duplicates': self.duplicates,
+            'invalid': self.invalid,
+            'errors': self.errors,
+        }
+
+    def import_file(self, stream, file_format=None):
+        """Imports every route of a file, routes of earlier batches stay if the file turns out malformed"""
+        try:
+            for number, fields in enumerate(iter_route_fields(stream, file_format), start=1):
+                if isinstance(fields, RouteImportError):
+                    self.reject(number, fields)
+                    continue
+                try:
+                    self.add(clean_route_fields(fields))
+                except RouteImportError as error:
+                    self.reject(number, error)
+        finally:
+            self.flush()
+            if self.created:
+                response_cache.bump_catalog_version()
+        return self.report()
+
+    def reject(self, number, error):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"Route {number}: {error}")
+
+    def add(self, fields):
+        if fields['title'] in self.seen_titles:
+            self.duplicates += 1
+            return
+        self.seen_titles.add(fields['title'])
+        self.batch.append(Route(user=self.user, **fields))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Inserts the batched routes the user does not have yet"""
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        existing = set(
+            Route.objects.filter(user=self.user, title__in=[route.title for route in batch])
+            .values_list('title', flat=True)
+        )
+        routes = [route for route in batch if route.title not in existing]
+        self.duplicates += len(batch) - len(routes)
+        for route in routes:
+            # bulk_create skips Route.save, which keeps these in sync
+            route.sync_geometry()
+        with transaction.atomic():
+            Route.objects.bulk_create(routes)
+            Route.sync_tag_index([route for route in routes if Tag.normalize_names(route.tags)])
+        Route.invalidate_tiles(*(route.start_geohash for route in routes))
+        self.created += len(routes)
@@ -0,0 +1,119 @@
+import re
+from functools import reduce
+from operator import or_
+import numpy as np
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast
+from . import geo
+
+# Portuguese text search configuration with unaccent, created in migration 0007
+SEARCH_CONFIG = 'public.portuguese_unaccent'
+
+
+def substring_search(queryset, term):
+    """Case-insensitive substring match on every searchable field"""
+    return queryset.filter(
+        Q(title__icontains=term) |
+        Q(description__icontains=term) |
+        Q(starting_location__icontains=term) |
+        Q(ending_location__icontains=term) |
+        Q(tags__icontains=term)
+    )
+
+
+def full_text_query(term):
+    """
+    Builds a tsquery matching the term as typed (websearch syntax) or with
+    every word used as a prefix, so partially typed words still match.
+    Returns None when the term has no words to search for.
+    """
+    words = re.findall(r'\w+', term)
+    if not words:
+        return None
+    prefix = ' & '.join(f'{word}:*' for word in words)
+    return (
+        SearchQuery(term, config=SEARCH_CONFIG, search_type='websearch') |
+        SearchQuery(prefix, config=SEARCH_CONFIG, search_type='raw')
+    )
+
+
+def search_routes(queryset, term):
+    """
+    Filters routes by the search term. On PostgreSQL this uses the weighted
+    `search_vector` column (title > locations > tags > description) and
+    annotates `search_rank`; other databases fall back to substring matching.
+    """
+    query = full_text_query(term) if connection.vendor == 'postgresql' else None
+    if query is None:
+        return substring_search(queryset, term)
+
+    # ts_rank is a float4, as a float8 it round-trips through pagination cursors
+    return queryset.filter(search_vector=query).annotate(
+        search_rank=Cast(SearchRank(F('search_vector'), query), FloatField())
+    ).order_by('-search_rank', '-created_at')
+
+
+def location_search(queryset, starting_location=None, ending_location=None):
+    """
+    Fuzzy matches routes by starting and/or ending location. On PostgreSQL
+    this uses the pg_trgm `%` operator (backed by the trigram GIN indexes)
+    and orders by the summed similarity as `location_similarity`; other
+    databases fall back to a case-insensitive substring match.
+    """
+    terms = {
+        field: term.strip()
+        for field, term in (
+            ('starting_location', starting_location),
+            ('ending_location', ending_location),
+        )
+        if term and term.strip()
+    }
+    if not terms:
+        return queryset
+
+    if connection.vendor != 'postgresql':
+        return queryset.filter(**{f'{field}__icontains': term for field, term in terms.items()})
+
+    queryset = queryset.filter(**{f'{field}__trigram_similar': term for field, term in terms.items()})
+    similarities = [TrigramSimilarity(field, term) for field, term in terms.items()]
+    # float4 like ts_rank, see search_routes
+    similarity = Cast(sum(similarities[1:], similarities[0]), FloatField())
+    return queryset.annotate(location_similarity=similarity).order_by(
+        '-location_similarity', '-created_at'
+    )
+
+
+# Geohash precisions tried by `nearest_routes`, from ~150m cells to ~5000km
+NEARBY_PRECISIONS = range(7, 0, -1)
+
+
+def rank_by_distance(lat, lng, candidates):
+    """Sorts (route_id, start_geohash) pairs by haversine distance to the point"""
+    if not candidates:
+        return []
+    route_ids, geohashes = zip(*candidates)
+    starts = np.array([geo.geohash_decode(geohash) for geohash in geohashes])
+    distances = geo.haversine_km(lat, lng, starts[:, 0], starts[:, 1])
+    order = np.argsort(distances, kind='stable')
+    return [(route_ids[i], float(distances[i])) for i in order]
+
+
+def nearest_routes(queryset, lat, lng, k):
+    """
+    Returns [(route_id, distance_km)] for the k routes whose start point is
+    closest to the point. Candidates come from prefix lookups on the indexed
+    `start_geohash` over the 3x3 cells around the point, widening the cells
+    until the k-th candidate is closer than anything outside them could be.
+    """
+    queryset = queryset.order_by().exclude(start_geohash='')
+    for precision in NEARBY_PRECISIONS:
+        cells = geo.geohash_neighborhood(lat, lng, precision)
+        in_cells = reduce(or_, (Q(start_geohash__startswith=cell) for cell in cells))
+        ranked = rank_by_distance(lat, lng, list(queryset.filter(in_cells).values_list('id', 'start_geohash')))
+        if len(ranked) >= k and ranked[k - 1][1] <= geo.geohash_search_radius_km(lat, precision):
+            return ranked[:k]
+
+    # Not enough routes close by to rule out the others
+    return rank_by_distance(lat, lng, list(queryset.values_list('id', 'start_geohash')))[:k]
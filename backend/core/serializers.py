@@ -1,6 +1,43 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import Route, UserDetails
+from . import geo, images
+from .models import Route, UserDetails, Vote
+
+GEOMETRY_FORMATS = ('coordinates', 'polyline')
+
+
+def requested_lod(request):
+    """Level of detail asked for with ?lod= or ?zoom=, 0 (the full trace) by default"""
+    params = request.query_params if request else {}
+    try:
+        if 'lod' in params:
+            lod = int(params['lod'])
+            if lod != 0 and lod not in geo.LOD_TOLERANCES_M:
+                raise ValueError(lod)
+            return lod
+        if 'zoom' in params:
+            zoom = int(params['zoom'])
+            if zoom < 0:
+                raise ValueError(zoom)
+            return geo.lod_for_zoom(zoom)
+    except ValueError:
+        raise serializers.ValidationError(
+            {"lod": f"lod must be one of 0-{max(geo.LOD_TOLERANCES_M)} and zoom a positive integer."}
+        )
+    return 0
+
+
+def requested_image_size(request):
+    """Image variant width asked for with ?image_size=, None for the original"""
+    size = request.query_params.get('image_size') if request else None
+    if size is None:
+        return None
+    if size not in map(str, images.VARIANT_WIDTHS):
+        raise serializers.ValidationError(
+            {"image_size": f"image_size must be one of {', '.join(map(str, images.VARIANT_WIDTHS))}."}
+        )
+    return size
+
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -16,47 +53,143 @@ class UserSerializer(serializers.ModelSerializer):
         user = User.objects.create_user(**validated_data)
         return user
 
+class RouteListSerializer(serializers.ListSerializer):
+    """
+    Renders a page of routes looking up the caller's votes for the
+    whole page at once instead of once per route
+    """
+    def to_representation(self, data):
+        routes = list(data.all() if hasattr(data, 'all') else data)
+        self.child.user_votes = self.child.get_user_votes([route.id for route in routes])
+        try:
+            return super().to_representation(routes)
+        finally:
+            self.child.user_votes = None
+
+class GeometryField(serializers.JSONField):
+    """Route coordinates, read at the level of detail asked for by the request"""
+    def get_attribute(self, instance):
+        return self.parent.get_geometry(instance)
+
 class RouteSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
-    distance = serializers.SerializerMethodField()
-    upvotes_count = serializers.SerializerMethodField()
-    downvotes_count = serializers.SerializerMethodField()
+    coordinates = GeometryField(required=False)
+    start_point = serializers.SerializerMethodField()
+    end_point = serializers.SerializerMethodField()
     user_vote = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = Route
         fields = ['id', 'user', 'username', 'title', 'description', 'starting_location', 'ending_location', 
-                  'coordinates', 'tags', 'created_at', 'distance', 'start_point', 'end_point', 'image', 'upvotes_count', 'downvotes_count', 'user_vote']
-        read_only_fields = ['id', 'created_at', 'user', 'distance', 'start_point', 'end_point']
+                  'coordinates', 'tags', 'created_at', 'updated_at', 'distance', 'start_point', 'end_point', 'image', 'image_variants', 'upvotes_count', 'downvotes_count', 'net_votes', 'user_vote']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'user', 'distance', 'start_point', 'end_point',
+                            'upvotes_count', 'downvotes_count', 'net_votes']
+        list_serializer_class = RouteListSerializer
+
+    # Votes of the request user primed by RouteListSerializer, keyed by route id
+    user_votes = None
+
+    # Left out when the context asks for light routes, see get_fields
+    GEOMETRY_OUTPUT_FIELDS = ('coordinates', 'start_point', 'end_point')
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.context.get('light'):
+            for name in self.GEOMETRY_OUTPUT_FIELDS:
+                fields.pop(name)
+        return fields
     
-    def get_distance(self, obj):
-        return obj.distance
+    def validate_tags(self, value):
+        if not isinstance(value, list) or not all(isinstance(tag, str) for tag in value):
+            raise serializers.ValidationError("Tags must be a list of strings.")
+        if any(len(tag.strip()) > 50 for tag in value):
+            raise serializers.ValidationError("Tags can have at most 50 characters.")
+        return value
+
+    def validate_coordinates(self, value):
+        if not isinstance(value, list):
+            raise serializers.ValidationError("Coordinates must be a list of [lat, lng] pairs.")
+        for point in value:
+            if (
+                not isinstance(point, (list, tuple))
+                or len(point) != 2
+                or not all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in point)
+            ):
+                raise serializers.ValidationError("Each coordinate must be a [lat, lng] pair of numbers.")
+            lat, lng = point
+            if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                raise serializers.ValidationError("Coordinates out of range.")
+        return value
+
+    def get_image_variants(self, obj):
+        """URLs of the resized copies of the image, {width: {"webp": url, "jpeg": url}}"""
+        storage = obj.image.storage
+        return {
+            width: {variant_format: storage.url(name) for variant_format, name in formats.items()}
+            for width, formats in obj.image_variants.items()
+        }
+
+    def get_geometry(self, obj):
+        """Coordinates of the route at the requested level of detail"""
+        return getattr(obj, Route.geometry_field(requested_lod(self.context.get('request'))))
+
+    def get_start_point(self, obj):
+        # Simplified geometries keep the first and last points
+        geometry = self.get_geometry(obj)
+        return geometry[0] if geometry else None
+
+    def get_end_point(self, obj):
+        geometry = self.get_geometry(obj)
+        return geometry[-1] if geometry else None
+
+    def get_geometry_format(self):
+        """Returns the coordinates format asked for with ?geometry="""
+        request = self.context.get('request')
+        geometry = request.query_params.get('geometry', 'coordinates') if request else 'coordinates'
+        if geometry not in GEOMETRY_FORMATS:
+            raise serializers.ValidationError(
+                {"geometry": f"Use one of: {', '.join(GEOMETRY_FORMATS)}."}
+            )
+        return geometry
 
     def to_representation(self, instance):
         rep = super().to_representation(instance)
+        size = requested_image_size(self.context.get('request'))
         if rep['image']:
-            # Just return the relative URL path
-            rep['image'] = instance.image.url
+            # Just return the relative URL path, of the WebP variant asked
+            # for with ?image_size= once it is generated
+            variant = instance.image_variants.get(size, {}).get('webp') if size else None
+            rep['image'] = instance.image.storage.url(variant) if variant else instance.image.url
+        if 'coordinates' in rep and self.get_geometry_format() == 'polyline':
+            # Google encoded polyline with 6 decimal digits (polyline6)
+            rep['polyline'] = geo.encode_polyline(rep.pop('coordinates'))
         return rep
     
     
-    def get_upvotes_count(self, obj):
-        return obj.upvotes.count()
-    
-    def get_downvotes_count(self, obj):
-        return obj.downvotes.count()
+    def get_user_votes(self, route_ids):
+        """Returns {route_id: vote} for the request user over route_ids in one query"""
+        request = self.context.get('request')
+        if not route_ids or not (request and request.user.is_authenticated):
+            return {}
+        
+        votes = Vote.objects.filter(
+            user_id=request.user.id, route_id__in=route_ids
+        ).values_list('route_id', 'value')
+        return {route_id: Vote(value=value).get_value_display() for route_id, value in votes}
     
     def get_user_vote(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            if request.user in obj.upvotes.all():
-                return "upvote"
-            elif request.user in obj.downvotes.all():
-                return "downvote"
-        return None
+        if self.user_votes is not None:
+            return self.user_votes.get(obj.id)
+        return self.get_user_votes([obj.id]).get(obj.id)
     
 class UserDetailsSerializer(serializers.ModelSerializer):
+    route_history = serializers.SerializerMethodField()
+
     class Meta:
         model = UserDetails
         fields = ['route_history']
-        read_only_fields = ['route_history']
\ No newline at end of file
+        read_only_fields = ['route_history']
+
+    def get_route_history(self, obj):
+        return obj.get_history()
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import re
+import uuid
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, storages
+
+# <sha256>.<extension>, the names given by ContentAddressedStorage
+ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}(\.[0-9a-z]{1,5})?$')
+# Files named by their content never change, clients may keep them forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def is_addressed(name):
+    """Whether a stored file is named by its content, which then never changes"""
+    return bool(name) and ADDRESSED_NAME.match(os.path.basename(name)) is not None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage naming files by the SHA-256 of their content, in
+    the directory they are saved to: route_images/Photo.JPG is stored as
+    route_images/<sha256>.jpg. Saving content already stored writes
+    nothing and returns the existing name, so identical uploads share one
+    file and a name always holds the same bytes. Files are shared, only
+    delete those no longer referenced, see StoredFile.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        return super().save(self.content_name(name, content), content, max_length=max_length)
+
+    def content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk if isinstance(chunk, bytes) else chunk.encode())
+        content.seek(0)
+        extension = os.path.splitext(name)[1].lower()
+        if not re.fullmatch(r'\.[0-9a-z]{1,5}', extension):
+            extension = ''
+        return os.path.join(os.path.dirname(name), digest.hexdigest() + extension)
+
+    def get_available_name(self, name, max_length=None):
+        # An existing file of that name has the same content, no suffix needed
+        if max_length is not None and len(name) > max_length:
+            raise SuspiciousFileOperation(f'Storage can not find an available filename for "{name}".')
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            return name
+        # Written under a temporary name and moved in place, so the file is
+        # never seen half written and racing saves of the same content are
+        # harmless
+        temporary = super()._save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(temporary), self.path(name))
+        return name
+
+
+def route_image_storage():
+    """Storage of Route.image and its variants, the 'route_images' entry of STORAGES"""
+    return storages['route_images']
@@ -0,0 +1,101 @@
+import math
+import numpy as np
+from django.core.cache import cache
+from . import geo
+
+# Zoom levels served, following the slippy map (Web Mercator) tile scheme
+TILE_MAX_ZOOM = 20
+# Below this zoom start points are clustered, from it on routes are listed
+CLUSTER_MAX_ZOOM = 15
+# Each tile is split in CLUSTER_GRID x CLUSTER_GRID clustering cells
+CLUSTER_GRID = 8
+# Number of route ids sent with each cluster, most recent first
+CLUSTER_SAMPLE_SIZE = 3
+TILE_CACHE_TIMEOUT = 60 * 60
+
+
+def tile_cache_key(z, x, y):
+    return f'route-tile:{z}:{x}:{y}'
+
+
+def tile_position(lat, lng, z):
+    """Fractional (x, y) tile coordinates of a point at zoom z"""
+    n = 2 ** z
+    lat = min(max(lat, -85.05112878), 85.05112878)
+    x = (lng + 180) / 360 * n
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+    return min(max(x, 0), n - 1e-9), min(max(y, 0), n - 1e-9)
+
+
+def tile_bounds(z, x, y):
+    """Returns (min_lat, min_lng, max_lat, max_lng) of a tile"""
+    n = 2 ** z
+
+    def lat_at(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lat_at(y + 1), x / n * 360 - 180, lat_at(y), (x + 1) / n * 360 - 180
+
+
+def build_tile(routes, z, x, y):
+    """
+    Clusters (or lists, at high zoom) the start points of routes in a tile.
+    `routes` is a Route queryset; only routes whose bounding box meets the
+    tile are loaded, then filtered on their start point.
+    """
+    min_lat, min_lng, max_lat, max_lng = tile_bounds(z, x, y)
+    candidates = routes.order_by().exclude(start_geohash='').filter(
+        max_lat__gte=min_lat, min_lat__lte=max_lat,
+        max_lng__gte=min_lng, min_lng__lte=max_lng,
+    ).values_list('id', 'title', 'start_geohash')
+
+    starts = []
+    for route_id, title, start_geohash in candidates:
+        lat, lng = geo.geohash_decode(start_geohash)
+        tile_x, tile_y = tile_position(lat, lng, z)
+        if int(tile_x) == x and int(tile_y) == y:
+            starts.append((route_id, title, lat, lng, tile_x - x, tile_y - y))
+
+    tile = {"z": z, "x": x, "y": y, "clusters": [], "routes": []}
+    if z >= CLUSTER_MAX_ZOOM:
+        tile["routes"] = [
+            {"id": route_id, "title": title, "start_point": [lat, lng]}
+            for route_id, title, lat, lng, _, _ in sorted(starts)
+        ]
+        return tile
+    if not starts:
+        return tile
+
+    route_ids = np.array([start[0] for start in starts])
+    points = np.array([start[2:4] for start in starts])
+    cells = (np.array([start[4:6] for start in starts]) * CLUSTER_GRID).astype(int)
+    _, cluster_of, counts = np.unique(
+        cells[:, 0] * CLUSTER_GRID + cells[:, 1], return_inverse=True, return_counts=True
+    )
+    for cluster, count in enumerate(counts.tolist()):
+        members = cluster_of == cluster
+        lat, lng = points[members].mean(axis=0).tolist()
+        sample = np.sort(route_ids[members])[::-1][:CLUSTER_SAMPLE_SIZE].tolist()
+        tile["clusters"].append({"lat": lat, "lng": lng, "count": count, "route_ids": sample})
+    return tile
+
+
+def get_tile(routes, z, x, y):
+    """`build_tile` through the cache"""
+    key = tile_cache_key(z, x, y)
+    tile = cache.get(key)
+    if tile is None:
+        tile = build_tile(routes, z, x, y)
+        cache.set(key, tile, TILE_CACHE_TIMEOUT)
+    return tile
+
+
+def invalidate_tiles(points):
+    """Drops the cached tiles, at every zoom, containing any of the [lat, lng] points"""
+    keys = set()
+    for lat, lng in points:
+        for z in range(TILE_MAX_ZOOM + 1):
+            tile_x, tile_y = tile_position(lat, lng, z)
+            keys.add(tile_cache_key(z, int(tile_x), int(tile_y)))
+    if keys:
+        cache.delete_many(list(keys))
@@ -0,0 +1,142 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import RouteView
+
+logger = logging.getLogger(__name__)
+
+
+class RouteViewBuffer:
+    """
+    Write-behind buffer of route views. Views are kept in memory, the last
+    one per user and route, and written with RouteView.record_many once
+    ROUTE_VIEW_BUFFER_SIZE are pending or ROUTE_VIEW_FLUSH_INTERVAL seconds
+    after the first one, whichever comes first. Views that fail to be
+    written are kept for the next flush.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+
+    def add(self, user_id, route_id, title=None, viewed_at=None):
+        viewed_at = viewed_at or timezone.now()
+        if settings.ROUTE_VIEW_BUFFER_SIZE <= 1:
+            RouteView.record(user_id, route_id, title, viewed_at)
+            return
+
+        with self.lock:
+            self.pending[(user_id, route_id)] = (title, viewed_at)
+            full = len(self.pending) >= settings.ROUTE_VIEW_BUFFER_SIZE
+            if not full:
+                self.schedule()
+        if full:
+            self.flush()
+
+    def schedule(self):
+        """Starts the flush timer if there is none, call with the lock held"""
+        interval = settings.ROUTE_VIEW_FLUSH_INTERVAL
+        if interval and self.timer is None:
+            self.timer = threading.Timer(interval, self.flush_from_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread's own connection
+            connection.close()
+
+    def take(self):
+        """Empties the buffer, returning its views"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        return [(user_id, route_id, title, viewed_at) for (user_id, route_id), (title, viewed_at) in pending.items()]
+
+    def flush(self):
+        """Writes the pending views, returns how many were written"""
+        views = self.take()
+        if not views:
+            return 0
+        try:
+            return RouteView.record_many(views)
+        except DatabaseError:
+            logger.exception("Could not write %d buffered route views, keeping them for the next flush", len(views))
+            self.requeue(views)
+            return 0
+
+    def requeue(self, views):
+        with self.lock:
+            for user_id, route_id, title, viewed_at in views:
+                # Views buffered in the meantime are more recent
+                self.pending.setdefault((user_id, route_id), (title, viewed_at))
+            self.schedule()
+
+    def pending_views(self, user_id):
+        """The user's views not written yet, as unsaved RouteViews"""
+        with self.lock:
+            return [
+                RouteView(user_id=user_id, route_id=route_id, title=title, viewed_at=viewed_at)
+                for (pending_user_id, route_id), (title, viewed_at) in self.pending.items()
+                if pending_user_id == user_id
+            ]
+
+    def discard(self, user_id=None):
+        """Drops the pending views of a user, or all of them"""
+        with self.lock:
+            for key in [key for key in self.pending if user_id is None or key[0] == user_id]:
+                del self.pending[key]
+
+    def shutdown(self):
+        """Flushes on exit, spooling the views to disk if the database cannot take them"""
+        views = self.take()
+        if not views:
+            return
+        try:
+            RouteView.record_many(views)
+        except Exception:
+            logger.exception("Could not write %d buffered route views on shutdown, spooling them", len(views))
+            spool(views)
+
+
+def spool(views):
+    """Writes views to a new file in ROUTE_VIEW_SPOOL_DIR, one JSON array per line"""
+    os.makedirs(settings.ROUTE_VIEW_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(settings.ROUTE_VIEW_SPOOL_DIR, f'route-views-{uuid.uuid4().hex}.jsonl')
+    with open(f'{path}.tmp', 'w') as spool_file:
+        for user_id, route_id, title, viewed_at in views:
+            spool_file.write(json.dumps([user_id, route_id, title, viewed_at.isoformat()]) + '\n')
+    # Only complete files get the name drain_spool looks for
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+def drain_spool():
+    """Writes the spooled views to the database, deleting each file once written"""
+    written = 0
+    for path in sorted(glob.glob(os.path.join(settings.ROUTE_VIEW_SPOOL_DIR, 'route-views-*.jsonl'))):
+        with open(path) as spool_file:
+            views = [
+                (user_id, route_id, title, parse_datetime(viewed_at))
+                for user_id, route_id, title, viewed_at in map(json.loads, spool_file)
+            ]
+        written += RouteView.record_many(views)
+        os.remove(path)
+    return written
+
+
+buffer = RouteViewBuffer()
+atexit.register(buffer.shutdown)
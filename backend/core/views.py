@@ -1,18 +1,26 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.db.models import Q
 from rest_framework import viewsets, status, filters, generics
 from rest_framework.decorators import api_view, action
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from django.contrib.auth.models import User
-from .models import Route, UserDetails
-from .serializers import RouteSerializer, UserSerializer, UserDetailsSerializer
-from django.db.models import Count, F, Q, ExpressionWrapper, FloatField
-from django.utils import timezone
-import datetime
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.views.static import serve
+from . import geo, response_cache, route_export, route_import, tiles, view_buffer
+from .models import Route, RouteTag, RouteView, Tag, UserDetails, Vote
+from .serializers import RouteSerializer, UserSerializer, UserDetailsSerializer, requested_lod
+from .pagination import KeysetPagination
+from .search import location_search, nearest_routes, search_routes
+from .storage import IMMUTABLE_CACHE_CONTROL, is_addressed
+from django.db.models import Count
+import hashlib
 
 class CreateUserView(generics.CreateAPIView):
     queryset = User.objects.all()
@@ -23,13 +31,24 @@ class CurrentUserView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        serializer = UserSerializer(request.user)
-        return Response(serializer.data)
+        # request.user may be built from the token claims, which carry no email
+        user = User.objects.filter(pk=request.user.pk).first()
+        if user is None:
+            # Deleted since the stateless token was issued
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        return Response(UserSerializer(user).data)
 
 class RouteViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
-    queryset = Route.objects.all().order_by('-created_at')
+    queryset = Route.objects.select_related('user').order_by('-created_at')
     serializer_class = RouteSerializer
+    
+    @property
+    def paginator(self):
+        """Keyset pagination when ?cursor= is given, page numbers otherwise"""
+        if not hasattr(self, '_paginator') and 'cursor' in self.request.query_params:
+            self._paginator = KeysetPagination()
+        return super().paginator
         
     def get_queryset(self):
         """
@@ -38,10 +57,13 @@ class RouteViewSet(viewsets.ModelViewSet):
         
         endpoints: /routes/?user=1
         or         /routes/?search=keyword
+        or         /routes/?from=HC&to=IC (fuzzy location match)
+        or         /routes/?tags=sombra,caminhada&tags_mode=all (or any)
+        or         /routes/?bbox=minLng,minLat,maxLng,maxLat (map viewport)
         or even    /routes/?user=1&search=keyword
         """
         
-        queryset = super().get_queryset()
+        queryset = self.defer_geometry(super().get_queryset())
         
         search_term = self.request.query_params.get('search', None)
         user_term = self.request.query_params.get('user', None)
@@ -58,33 +80,27 @@ class RouteViewSet(viewsets.ModelViewSet):
                 return self.queryset.none()
         
         if search_term:
-            queryset = queryset.filter(
-                Q(title__icontains=search_term) | 
-                Q(description__icontains=search_term) |
-                Q(starting_location__icontains=search_term) |
-                Q(ending_location__icontains=search_term) |
-                Q(tags__icontains=search_term)
-            )
+            queryset = search_routes(queryset, search_term)
+        
+        tags_term = self.request.query_params.get('tags', None)
+        if tags_term:
+            queryset = self.filter_by_tags(queryset, tags_term)
+        
+        bbox_term = self.request.query_params.get('bbox', None)
+        if bbox_term:
+            queryset = self.filter_by_bbox(queryset, bbox_term)
+        
+        starting_term = self.request.query_params.get('from', None)
+        ending_term = self.request.query_params.get('to', None)
+        if starting_term or ending_term:
+            queryset = location_search(queryset, starting_term, ending_term)
         
         if order_by:
             if order_by == 'liked':
-                queryset = queryset.annotate(
-                    upvote_count=Count('upvotes'),
-                    downvote_count=Count('downvotes'),
-                    net_votes=F('upvote_count') - F('downvote_count')
-                ).order_by('-net_votes')
+                queryset = queryset.order_by('-net_votes', '-created_at')
             elif order_by == 'trending':
-                seven_days_ago = timezone.now() - datetime.timedelta(days=7)
-            
-                # Count recent upvotes and downvotes
-                queryset = queryset.annotate(
-                    recent_upvotes=Count('upvotes', filter=Q(upvotes__date_joined__gte=seven_days_ago)),
-                    recent_downvotes=Count('downvotes', filter=Q(downvotes__date_joined__gte=seven_days_ago)),
-                    trending_score=ExpressionWrapper(
-                        F('recent_upvotes') * 3 - F('recent_downvotes') * 2,
-                        output_field=FloatField()
-                    )
-                ).order_by('-trending_score')
+                # Materialized by Route.cast_vote and update_trending_scores
+                queryset = queryset.order_by('-trending_score', '-created_at')
             elif order_by in ['created_at', '-created_at']:
                     queryset = queryset.order_by(order_by)
             else:
@@ -93,6 +109,122 @@ class RouteViewSet(viewsets.ModelViewSet):
         
         return queryset
 
+    def defer_geometry(self, queryset):
+        """On reads, only load the coordinates column of the requested level of detail"""
+        if self.request.method != 'GET':
+            return queryset
+        lod = requested_lod(self.request)
+        return queryset.defer(*(
+            Route.geometry_field(level) for level in (0, *geo.LOD_TOLERANCES_M) if level != lod
+        ))
+    
+    def filter_by_tags(self, queryset, tags_term):
+        """Exact tag filter, matching all (default) or any of the given tags"""
+        names = Tag.normalize_names(tags_term.split(','))
+        tags_mode = self.request.query_params.get('tags_mode', 'all')
+        if tags_mode not in ('all', 'any'):
+            raise ValidationError({"error": "tags_mode must be 'all' or 'any'"})
+        if not names:
+            return queryset
+        
+        matches = RouteTag.objects.filter(tag__name__in=names).values('route_id')
+        if tags_mode == 'all':
+            matches = matches.annotate(matched=Count('tag_id')).filter(matched=len(names))
+        return queryset.filter(id__in=matches.values('route_id'))
+    
+    def filter_by_bbox(self, queryset, bbox_term):
+        """Routes whose bounding box intersects the given viewport"""
+        try:
+            min_lng, min_lat, max_lng, max_lat = geo.parse_bbox(bbox_term)
+        except ValueError:
+            raise ValidationError({"error": "bbox must be minLng,minLat,maxLng,maxLat"})
+        
+        return queryset.filter(
+            max_lat__gte=min_lat,
+            min_lat__lte=max_lat,
+            max_lng__gte=min_lng,
+            min_lng__lte=max_lng,
+        )
+    
+    def etag(self, request, *parts):
+        """Strong ETag of what the request user sees of a representation identified by parts"""
+        digest = hashlib.sha1(':'.join(map(str, (*parts, request.user.pk))).encode()).hexdigest()
+        return quote_etag(digest)
+    
+    def not_modified(self, request, etag, last_modified):
+        """The 304 (or 412) answer to a conditional request, None if the full response is due"""
+        response = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+        if response is not None:
+            self.set_validators(response, etag, last_modified)
+        return response
+    
+    def set_validators(self, response, etag, last_modified):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+        # Let browsers keep the response but check back with the ETag every time
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+        return response
+    
+    def list(self, request, *args, **kwargs):
+        """
+        Serves list and search pages from the versioned response cache.
+        Cached pages are shared by every user, the caller's votes are
+        filled in on the way out. Conditional requests are answered from
+        the catalog version alone.
+        """
+        version = response_cache.catalog_version()
+        key = response_cache.list_cache_key(request, version)
+        etag = self.etag(request, key)
+        last_modified = response_cache.catalog_modified(version)
+        not_modified = self.not_modified(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        
+        data = cache.get(key)
+        if data is None:
+            response_cache.record_miss()
+            response = super().list(request, *args, **kwargs)
+            data = response.data
+            cache.set(key, {
+                **data,
+                'results': [{**route, 'user_vote': None} for route in data['results']],
+            }, response_cache.LIST_CACHE_TIMEOUT)
+            response['X-Cache'] = 'MISS'
+            return self.set_validators(response, etag, last_modified)
+        
+        response_cache.record_hit()
+        routes = data['results']
+        user_votes = self.get_serializer().get_user_votes([route['id'] for route in routes])
+        for route in routes:
+            route['user_vote'] = user_votes.get(route['id'])
+        response = Response(data, status=status.HTTP_200_OK, headers={'X-Cache': 'HIT'})
+        return self.set_validators(response, etag, last_modified)
+    
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Route detail, answering conditional requests from the route's
+        updated_at without loading or serializing the route
+        """
+        try:
+            updated_at = (
+                self.filter_queryset(self.get_queryset())
+                .filter(pk=kwargs['pk'])
+                .values_list('updated_at', flat=True)
+                .first()
+            )
+        except (TypeError, ValueError):
+            updated_at = None
+        if updated_at is None:
+            # Let the regular lookup answer with the 404
+            return super().retrieve(request, *args, **kwargs)
+        
+        etag = self.etag(request, kwargs['pk'], updated_at.isoformat(), sorted(request.query_params.lists()))
+        not_modified = self.not_modified(request, etag, updated_at)
+        if not_modified is not None:
+            return not_modified
+        return self.set_validators(super().retrieve(request, *args, **kwargs), etag, updated_at)
+    
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
     
@@ -163,7 +295,7 @@ class RouteViewSet(viewsets.ModelViewSet):
         Custom action to get routes liked (upvoted) by the current user.
         endpoints: /routes/my_liked_routes/
         """
-        liked_routes = self.get_queryset().filter(upvotes=request.user)
+        liked_routes = self.get_queryset().filter(votes__user=request.user, votes__value=Vote.UP)
         
         page = self.paginate_queryset(liked_routes)
         if page is not None:
@@ -173,78 +305,220 @@ class RouteViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(liked_routes, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
     
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def tag_facets(self, request):
+        """
+        Number of routes per tag among the routes matching the current filters.
+        endpoints: /routes/tag_facets/?search=keyword
+        """
+        route_ids = self.get_queryset().values('id')
+        facets = (
+            RouteTag.objects.filter(route_id__in=route_ids)
+            .values('tag__name')
+            .annotate(count=Count('route_id'))
+            .order_by('-count', 'tag__name')
+        )
+        return Response(
+            [{"tag": facet['tag__name'], "count": facet['count']} for facet in facets],
+            status=status.HTTP_200_OK
+        )
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def nearby(self, request):
+        """
+        The k routes starting closest to a point, nearest first, honoring the
+        same filters as the list. `distance_to_start` is in kilometers.
+        endpoints: /routes/nearby/?lat=-22.8175&lng=-47.0707&k=10
+        """
+        try:
+            lat = float(request.query_params['lat'])
+            lng = float(request.query_params['lng'])
+            k = int(request.query_params.get('k', 10))
+        except (KeyError, ValueError):
+            raise ValidationError({"error": "lat and lng are required numbers and k an integer"})
+        
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180 and 1 <= k <= 50):
+            raise ValidationError({"error": "lat, lng or k out of range (k must be 1 to 50)"})
+        
+        nearest = nearest_routes(self.get_queryset(), lat, lng, k)
+        routes = self.defer_geometry(self.queryset).in_bulk([route_id for route_id, _ in nearest])
+        found = [(routes[route_id], distance) for route_id, distance in nearest if route_id in routes]
+        serializer = self.get_serializer([route for route, _ in found], many=True)
+        
+        data = serializer.data
+        for route, (_, distance) in zip(data, found):
+            route['distance_to_start'] = distance
+        return Response(data, status=status.HTTP_200_OK)
+    
+    @action(
+        detail=False,
+        methods=['get'],
+        permission_classes=[IsAuthenticated],
+        url_path=r'tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)',
+        url_name='tiles'
+    )
+    def map_tile(self, request, z, x, y):
+        """
+        Route start points in a map tile: clusters with a count and a few route
+        ids at low zoom, the routes themselves from CLUSTER_MAX_ZOOM on.
+        endpoints: /routes/tiles/{z}/{x}/{y}/
+        """
+        z, x, y = int(z), int(x), int(y)
+        if z > tiles.TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            raise ValidationError({"error": f"Invalid tile, zoom goes up to {tiles.TILE_MAX_ZOOM}"})
+        
+        return Response(tiles.get_tile(Route.objects.all(), z, x, y), status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        methods=['post'],
+        permission_classes=[IsAdminUser],
+        parser_classes=[MultiPartParser],
+        url_path='import',
+        url_name='import'
+    )
+    def import_routes(self, request):
+        """
+        Staff-only bulk import of the routes in an uploaded GeoJSON
+        FeatureCollection or GPX file, owned by the uploader. Routes the
+        uploader already has a route titled like are skipped.
+        endpoints: /routes/import/ (multipart, fields: file, batch_size)
+        """
+        route_file = request.FILES.get('file')
+        if route_file is None:
+            raise ValidationError({"file": "Upload a GeoJSON or GPX file."})
+        try:
+            batch_size = int(request.data.get('batch_size', route_import.DEFAULT_BATCH_SIZE))
+        except ValueError:
+            raise ValidationError({"batch_size": "batch_size must be an integer."})
+        if not 1 <= batch_size <= 5000:
+            raise ValidationError({"batch_size": "batch_size must be 1 to 5000."})
+
+        importer = route_import.RouteImporter(request.user, batch_size=batch_size)
+        try:
+            importer.import_file(route_file)
+        except route_import.RouteImportError as error:
+            # Batches inserted before the error are kept and reported
+            return Response({"error": str(error), **importer.report()}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(importer.report(), status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        methods=['get'],
+        permission_classes=[IsAuthenticated],
+        renderer_classes=[route_export.GeoJSONRenderer, route_export.NDJSONRenderer],
+        content_negotiation_class=route_export.ExportContentNegotiation,
+    )
+    def export(self, request):
+        """
+        Every route matching the list filters, unpaginated, streamed as a
+        GeoJSON FeatureCollection or as newline-delimited JSON. Rows are
+        read in chunks, so memory use does not grow with the catalog.
+        endpoints: /routes/export/?format=geojson (default) or ?format=ndjson, plus the list filters
+        """
+        export_format = request.accepted_renderer.format
+        records = route_export.route_records(self.get_queryset(), lod=requested_lod(request))
+        response = StreamingHttpResponse(
+            route_export.iter_export(records, export_format),
+            content_type=f'{request.accepted_renderer.media_type}; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="routes.{export_format}"'
+        return response
+
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
+    def gpx(self, request, pk=None):
+        """
+        The route as a GPX track, for watches and phones.
+        endpoints: /routes/{id}/gpx/
+        """
+        return self.route_file(request, pk, 'gpx')
+
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
+    def kml(self, request, pk=None):
+        """
+        The route as a KML placemark.
+        endpoints: /routes/{id}/kml/
+        """
+        return self.route_file(request, pk, 'kml')
+
+    def route_file(self, request, pk, file_format):
+        """
+        Download of the route rendered by route_export.render_route_file.
+        Renderings are cached by route id and updated_at, so each version
+        of a route is rendered once and an edit makes a new one.
+        """
+        route = generics.get_object_or_404(Route.objects.only('id', 'updated_at'), pk=pk)
+        etag = self.etag(request, file_format, route.pk, route.updated_at.isoformat())
+        not_modified = self.not_modified(request, etag, route.updated_at)
+        if not_modified is not None:
+            return not_modified
+
+        key = f'route-file:{file_format}:{route.pk}:{route.updated_at.isoformat()}'
+        content = cache.get(key)
+        cache_status = 'HIT'
+        if content is None:
+            cache_status = 'MISS'
+            route = generics.get_object_or_404(
+                Route.objects.only('id', 'title', 'description', 'coordinates', 'updated_at'), pk=route.pk
+            )
+            content = route_export.render_route_file(route, file_format)
+            cache.set(key, content, route_export.ROUTE_FILE_CACHE_TIMEOUT)
+
+        response = HttpResponse(content, content_type=route_export.ROUTE_FILE_TYPES[file_format])
+        response['Content-Disposition'] = f'attachment; filename="route-{route.pk}.{file_format}"'
+        response['X-Cache'] = cache_status
+        return self.set_validators(response, etag, route.updated_at)
+
+    @action(detail=True, methods=['post', 'put'], permission_classes=[IsAuthenticated])
     def vote(self, request, pk=None):
         """
         Endpoint for upvoting/downvoting a route
-        payload example: {"vote_type": "upvote"} or {"vote_type": "downvote"}
+        POST toggles: voting again with the same type takes the vote back
+        PUT sets the vote and is idempotent, "none" removes it
+        payload example: {"vote_type": "upvote"}, {"vote_type": "downvote"} or (PUT) {"vote_type": "none"}
         """
         route = self.get_object()
-        user = request.user
         vote_type = request.data.get('vote_type', '').lower()
+        vote_types = {'upvote': Vote.UP, 'downvote': Vote.DOWN}
+        if request.method == 'PUT':
+            vote_types['none'] = None
         
-        if vote_type == 'upvote':
-            route.downvotes.remove(user)
-            if user in route.upvotes.all():
-                route.upvotes.remove(user)
-                message = "Removed upvote"
-            else:
-                route.upvotes.add(user)
-                message = "Added upvote"
-        
-        elif vote_type == 'downvote':
-            route.upvotes.remove(user)
-            if user in route.downvotes.all():
-                route.downvotes.remove(user)
-                message = "Removed downvote"
-            else:
-                route.downvotes.add(user)
-                message = "Added downvote"
-        
-        else:
+        if vote_type not in vote_types:
             return Response(
-                {"error": "Unvalid vote. Use 'upvote' or 'downvote'."},
+                {"error": f"Unvalid vote. Use {' or '.join(repr(t) for t in vote_types)}."},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        route.save()
+        toggle = request.method == 'POST'
+        value = route.cast_vote(request.user, vote_types[vote_type], toggle=toggle)
+        user_vote = Vote(value=value).get_value_display() if value is not None else None
+        if not toggle:
+            message = f"Vote set to {vote_type}"
+        elif user_vote:
+            message = f"Added {vote_type}"
+        else:
+            message = f"Removed {vote_type}"
+        
+        route.refresh_from_db(fields=['upvotes_count', 'downvotes_count', 'net_votes'])
         return Response({
             "message": message,
-            "upvotes_count": route.upvotes.count(),
-            "downvotes_count": route.downvotes.count(),
-            "user_vote": self.get_user_vote(route, user)
+            "upvotes_count": route.upvotes_count,
+            "downvotes_count": route.downvotes_count,
+            "user_vote": user_vote
         }, status=status.HTTP_200_OK)
     
-    def get_user_vote(self, route, user):
-        """Returns the users vote for the route"""
-        if user in route.upvotes.all():
-            return "upvote"
-        elif user in route.downvotes.all():
-            return "downvote"
-        return None
-    
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def add_to_history(self, request, pk=None):
         """
-        Add a route to the user's view history
+        Add a route to the user's view history. The view is buffered and
+        written in a batch with others, see core.view_buffer.
         """
-        try:
-            route = self.get_object()
-            user_details = request.user.details
-            
-            # Add to history
-            user_details.add_to_history(
-                route_id=route.id,
-                route_title=route.title
-            )
-            
-            return Response({
-                "message": "Added to history"
-            }, status=status.HTTP_200_OK)
-        except Exception as e:
-            return Response({
-                "error": str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
+        route = generics.get_object_or_404(Route.objects.only('id', 'title'), pk=pk)
+        view_buffer.buffer.add(request.user.id, route.id, route.title)
+        
+        return Response({
+            "message": "Added to history"
+        }, status=status.HTTP_200_OK)
         
 class UserDetailsViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
@@ -255,40 +529,66 @@ class UserDetailsViewSet(viewsets.ReadOnlyModelViewSet):
     
     @action(detail=False, methods=['get'])
     def route_history(self, request):
-        """Get the user's route viewing history"""
+        """
+        Get the user's route viewing history, most recent first, each entry
+        merged with its route. Costs the same few queries for any length.
+        ?limit= caps the number of entries; with ?cursor= the history is
+        paged (limit entries per page) and comes as {"next", "results"}.
+        ?light=true leaves the geometry out. Views still buffered by this
+        process are merged in, except on cursor pages; views buffered by
+        other processes show up once written (ROUTE_VIEW_FLUSH_INTERVAL).
+        endpoints: /user-details/route_history/
+        """
+        limit = request.query_params.get('limit')
         try:
-            # Get the complete history without any limit
-            history = request.user.details.get_history()
-            
-            detailed_history = []
-            for entry in history:
-                route_id = entry.get('route_id')
-                try:
-                    route = Route.objects.get(id=route_id)
-                    # Use the RouteSerializer to serialize the route
-                    route_serializer = RouteSerializer(route, context={'request': request})
-                    # Merge the history entry with the serialized route data
-                    detailed_entry = {
-                        **entry,
-                        **route_serializer.data
-                    }
-                    detailed_history.append(detailed_entry)
-                except Route.DoesNotExist:
-                    detailed_history.append(entry)
-            
-            return Response(detailed_history, status=status.HTTP_200_OK)
-        except Exception as e:
-            return Response({
-                "error": str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
+            limit = int(limit) if limit else RouteView.HISTORY_LIMIT
+            if not 1 <= limit <= RouteView.HISTORY_LIMIT:
+                raise ValueError(limit)
+        except ValueError:
+            raise ValidationError({"limit": f"limit must be between 1 and {RouteView.HISTORY_LIMIT}."})
+        light = request.query_params.get('light', '').lower() in ('1', 'true')
+        
+        views = RouteView.objects.filter(user=request.user).order_by('-viewed_at', '-id')
+        paginator = None
+        if 'cursor' in request.query_params:
+            paginator = KeysetPagination()
+            paginator.page_size = limit
+            views = paginator.paginate_queryset(views, request, view=self)
+        else:
+            # The latest view of each route, buffered or written
+            pending = view_buffer.buffer.pending_views(request.user.id)
+            latest = {view.route_id: view for view in views[:limit + len(pending)]}
+            for view in pending:
+                if view.route_id not in latest or latest[view.route_id].viewed_at < view.viewed_at:
+                    latest[view.route_id] = view
+            views = sorted(latest.values(), key=lambda view: view.viewed_at, reverse=True)[:limit]
+        
+        routes = Route.objects.select_related('user')
+        if light:
+            routes = routes.defer(*(Route.geometry_field(level) for level in (0, *geo.LOD_TOLERANCES_M)))
+        else:
+            lod = requested_lod(request)
+            routes = routes.defer(*(
+                Route.geometry_field(level) for level in (0, *geo.LOD_TOLERANCES_M) if level != lod
+            ))
+        routes = routes.in_bulk([view.route_id for view in views])
+        
+        found = [routes[view.route_id] for view in views if view.route_id in routes]
+        serialized = RouteSerializer(found, many=True, context={'request': request, 'light': light}).data
+        route_data = {route['id']: route for route in serialized}
+        
+        # Routes deleted since they were viewed are listed with the entry alone
+        history = [{**view.as_entry(), **route_data.get(view.route_id, {})} for view in views]
+        if paginator is not None:
+            return paginator.get_paginated_response(history)
+        return Response(history, status=status.HTTP_200_OK)
             
     @action(detail=False, methods=['delete'])
     def clear_history(self, request):
         """Clear the user's route history"""
         try:
-            user_details = request.user.details
-            user_details.route_history = []
-            user_details.save()
+            view_buffer.buffer.discard(request.user.id)
+            RouteView.objects.filter(user=request.user).delete()
             
             return Response({
                 "message": "History cleared"
@@ -296,4 +596,14 @@ class UserDetailsViewSet(viewsets.ReadOnlyModelViewSet):
         except Exception as e:
             return Response({
                 "error": str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+def serve_media(request, path, document_root=None, show_indexes=False):
+    """
+    django.views.static.serve for MEDIA_URL, letting clients cache the
+    content-addressed files (see core.storage) for good
+    """
+    response = serve(request, path, document_root=document_root, show_indexes=show_indexes)
+    if response.status_code == 200 and is_addressed(path):
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
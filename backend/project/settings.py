@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 from datetime import timedelta
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -27,6 +28,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'rest_framework',
     'django_filters'
@@ -82,6 +84,35 @@ DATABASES = {
     }
 }
 
+# Redis, or any server speaking its protocol, when REDIS_URL is set (see
+# docker-compose.yml). Otherwise each process caches in its own memory, which
+# is only right with a single process (runserver, tests): a change made
+# through one worker would not invalidate what the others cached.
+# 'catalog' holds the route catalog version, without expiry. It must never be
+# evicted: the Redis server only evicts keys with a timeout (volatile-lru),
+# and in memory it is kept apart from the culled response entries.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        },
+        'catalog': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'catalog': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'catalog',
+        },
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -123,6 +154,27 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    # Route images are named by their content hash and shared between
+    # routes, see core/storage.py
+    'route_images': {'BACKEND': 'core.storage.ContentAddressedStorage'},
+}
+
+# Threads resizing uploaded route images into their variants (see
+# core/images.py), 0 resizes them right away in the request
+IMAGE_VARIANT_WORKERS = int(os.environ.get('IMAGE_VARIANT_WORKERS', 2))
+
+# Route views are buffered in each process and written in batches when
+# ROUTE_VIEW_BUFFER_SIZE are pending or ROUTE_VIEW_FLUSH_INTERVAL seconds
+# after the first one (a size of 1 writes every view right away). Views a
+# process could not write on shutdown are spooled to ROUTE_VIEW_SPOOL_DIR
+# for `manage.py drain_route_views`.
+ROUTE_VIEW_BUFFER_SIZE = int(os.environ.get('ROUTE_VIEW_BUFFER_SIZE', 200))
+ROUTE_VIEW_FLUSH_INTERVAL = float(os.environ.get('ROUTE_VIEW_FLUSH_INTERVAL', 2))
+ROUTE_VIEW_SPOOL_DIR = os.environ.get('ROUTE_VIEW_SPOOL_DIR', os.path.join(BASE_DIR, 'route_view_spool'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -130,6 +182,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_REDIRECT_URL = "/" 
 
+# 'stateless' builds request.user from the signed token claims without a
+# query, 'database' (or 'db') loads the user row on every request
+JWT_AUTH_MODE = os.environ.get('JWT_AUTH_MODE', 'stateless')
+if JWT_AUTH_MODE == 'db':
+    JWT_AUTH_MODE = 'database'
+if JWT_AUTH_MODE not in ('stateless', 'database'):
+    raise ImproperlyConfigured(f"JWT_AUTH_MODE must be 'stateless' or 'database', not {JWT_AUTH_MODE!r}")
+# Users of tokens issued without the claims are cached this many seconds
+JWT_USER_CACHE_TTL = int(os.environ.get('JWT_USER_CACHE_TTL', 60))
+JWT_USER_CACHE_SIZE = 1024
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 12,    # Set it to a multiple of 3 for grid layout
@@ -137,7 +200,9 @@ REST_FRAMEWORK = {
     
     # JWT Authentication settings
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.StatelessJWTAuthentication'
+        if JWT_AUTH_MODE == 'stateless'
+        else 'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -147,5 +212,7 @@ REST_FRAMEWORK = {
 # JWT settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=30),
-    'REFRESH_TOKEN_LIFETIME': timedelta(days=1)
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'core.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'core.authentication.ClaimsTokenRefreshSerializer',
 }
\ No newline at end of file
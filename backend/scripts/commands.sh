@@ -8,9 +8,24 @@ echo "🛠️ Aplicando migrações do banco de dados..."
 python manage.py makemigrations --noinput
 python manage.py migrate --noinput
 
+echo "📐 Calculando a geometria das rotas existentes..."
+python manage.py backfill_route_geometry
+
+echo "📥 Gravando visualizações de rotas pendentes..."
+python manage.py drain_route_views
+
+echo "📈 Atualizando as pontuações de tendência das rotas..."
+python manage.py update_trending_scores
+
 echo "Populando tabelas"
 python manage.py seed_data
 
+echo "#️⃣ Renomeando as imagens das rotas pelo conteúdo..."
+python manage.py address_route_images
+
+echo "🖼️ Gerando as variantes das imagens das rotas..."
+python manage.py backfill_image_variants
+
 if [ "$DJANGO_SUPERUSER_USERNAME" ] && [ "$DJANGO_SUPERUSER_EMAIL" ] && [ "$DJANGO_SUPERUSER_PASSWORD" ]; then
   echo "👤 Criando superusuário (se necessário)..."
   python manage.py shell <<EOF
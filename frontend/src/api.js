@@ -66,8 +66,10 @@ export const api = {
     if (orderBy) params.append("order_by", orderBy);
     return caller.get(`/routes/?${params.toString()}`);
   },
+  getRouteTile: (z, x, y) => caller.get(`/routes/tiles/${z}/${x}/${y}/`),
+  // Sets the vote to "upvote", "downvote" or "none"; repeating it is harmless
   voteRoute: (id, voteType) =>
-    caller.post(`/routes/${id}/vote/`, { vote_type: voteType }),
+    caller.put(`/routes/${id}/vote/`, { vote_type: voteType }),
 
   getRouteHistory: () => caller.get(`/user-details/route_history/`),
 
@@ -62,7 +62,10 @@ const ExpandedRouteCard = ({
 
     setVoteLoading(true);
     try {
-      const response = await api.voteRoute(route.id, voteType);
+      const response = await api.voteRoute(
+        route.id,
+        route.user_vote === voteType ? "none" : voteType
+      );
 
       // Update local state with new vote counts
       const updatedRoute = {
@@ -174,11 +177,28 @@ const ExpandedRouteCard = ({
           {/* Route Image or Placeholder */}
           <div className="w-full h-48 rounded-lg overflow-hidden bg-gray-100">
             {route.image ? (
-              <img
-                src={route.image}
-                alt={route.title}
-                className="w-full h-full object-cover"
-              />
+              <picture className="block w-full h-full">
+                {/* Resized copies generated by the backend, the original until they exist */}
+                {["webp", "jpeg"].map((format) =>
+                  route.image_variants?.["320"]?.[format] ? (
+                    <source
+                      key={format}
+                      type={`image/${format}`}
+                      sizes="(min-width: 768px) 33vw, 100vw"
+                      srcSet={Object.entries(route.image_variants)
+                        .filter(([, urls]) => urls?.[format])
+                        .map(([width, urls]) => `${urls[format]} ${width}w`)
+                        .join(", ")}
+                    />
+                  ) : null
+                )}
+                <img
+                  src={route.image}
+                  alt={route.title}
+                  loading="lazy"
+                  className="w-full h-full object-cover"
+                />
+              </picture>
             ) : (
               <div className="w-full h-full flex items-center justify-center bg-gradient-to-br from-gray-100 to-gray-200">
                 <div className="text-center text-gray-400">
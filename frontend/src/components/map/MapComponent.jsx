@@ -13,6 +13,7 @@ import "leaflet-draw";
 import "leaflet-draw/dist/leaflet.draw.css";
 import MapHeader from "./MapHeader";
 import MapFooter from "./MapFooter";
+import RouteStartsLayer from "./RouteStartsLayer";
 
 // Fix Leaflet's default icon path issue
 import icon from "leaflet/dist/images/marker-icon.png";
@@ -154,6 +155,7 @@ const MapComponent = ({
   center = null,
   zoom = 13,
   readOnly = false,
+  showRouteStarts = false,
 }) => {
   // Use useMemo for initial state to avoid unnecessary re-renders
   const initialPathCoordinates = useMemo(() => coordinates, []);
@@ -254,6 +256,8 @@ const MapComponent = ({
             attribution='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
           />
 
+          {showRouteStarts && <RouteStartsLayer />}
+
           {/* Show either draw controls or just the polyline depending on readOnly */}
           {!readOnly ? (
             <>
@@ -297,6 +301,8 @@ MapComponent.propTypes = {
   center: PropTypes.arrayOf(PropTypes.number),
   zoom: PropTypes.number,
   readOnly: PropTypes.bool,
+  // Marks the start of every route in view, see RouteStartsLayer
+  showRouteStarts: PropTypes.bool,
 };
 
 export default MapComponent;
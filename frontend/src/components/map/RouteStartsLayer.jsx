@@ -0,0 +1,95 @@
+import { Fragment, useCallback, useEffect, useRef, useState } from "react";
+import { CircleMarker, Marker, Tooltip, useMap, useMapEvents } from "react-leaflet";
+import { useNavigate } from "react-router-dom";
+import api from "../../api";
+
+// Same tile scheme as the map background (256px Web Mercator tiles)
+const TILE_SIZE = 256;
+const TILE_MAX_ZOOM = 20;
+
+// Tiles covering the visible part of the map at its current zoom
+const visibleTiles = (map) => {
+  const z = Math.min(Math.round(map.getZoom()), TILE_MAX_ZOOM);
+  const bounds = map.getPixelBounds();
+  const last = 2 ** z - 1;
+  const tileAt = (pixels) => Math.min(Math.max(Math.floor(pixels / TILE_SIZE), 0), last);
+  const tiles = [];
+  for (let x = tileAt(bounds.min.x); x <= tileAt(bounds.max.x); x++) {
+    for (let y = tileAt(bounds.min.y); y <= tileAt(bounds.max.y); y++) {
+      tiles.push({ z, x, y });
+    }
+  }
+  return tiles;
+};
+
+// Start points of the routes in view, clustered by the API below street level
+const RouteStartsLayer = () => {
+  const map = useMap();
+  const navigate = useNavigate();
+  // Tiles already loaded, keyed "z/x/y"
+  const loaded = useRef(new Map());
+  const [tiles, setTiles] = useState([]);
+
+  const loadVisibleTiles = useCallback(() => {
+    const visible = visibleTiles(map);
+    Promise.all(
+      visible.map(({ z, x, y }) => {
+        const key = `${z}/${x}/${y}`;
+        if (!loaded.current.has(key)) {
+          loaded.current.set(
+            key,
+            api.getRouteTile(z, x, y).then(
+              (response) => response.data,
+              (error) => {
+                console.error("Error fetching route tile:", error);
+                loaded.current.delete(key);
+                return null;
+              }
+            )
+          );
+        }
+        return loaded.current.get(key);
+      })
+    ).then((data) => {
+      // Ignore answers for a view the user already left
+      if (visible[0]?.z === Math.min(Math.round(map.getZoom()), TILE_MAX_ZOOM)) {
+        setTiles(data.filter(Boolean));
+      }
+    });
+  }, [map]);
+
+  useMapEvents({ moveend: loadVisibleTiles });
+  useEffect(() => {
+    loadVisibleTiles();
+  }, [loadVisibleTiles]);
+
+  return tiles.map((tile) => (
+    <Fragment key={`${tile.z}/${tile.x}/${tile.y}`}>
+      {tile.clusters.map((cluster) => (
+        <CircleMarker
+          key={`${cluster.lat},${cluster.lng}`}
+          center={[cluster.lat, cluster.lng]}
+          radius={Math.min(8 + Math.log2(cluster.count) * 3, 24)}
+          pathOptions={{ color: "#2563eb", fillOpacity: 0.5 }}
+          eventHandlers={{
+            // Zooms in on the cluster until its routes are listed
+            click: () => map.setView([cluster.lat, cluster.lng], tile.z + 2),
+          }}
+        >
+          <Tooltip>{`${cluster.count} rotas`}</Tooltip>
+        </CircleMarker>
+      ))}
+      {tile.routes.map((route) => (
+        <Marker
+          key={route.id}
+          position={route.start_point}
+          eventHandlers={{ click: () => navigate(`/routes/${route.id}`) }}
+        >
+          <Tooltip>{route.title}</Tooltip>
+        </Marker>
+      ))}
+    </Fragment>
+  ));
+};
+
+export default RouteStartsLayer;
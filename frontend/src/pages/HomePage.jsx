@@ -84,6 +84,7 @@ const HomePage = () => {
                   center={centerCoordinates}
                   zoom={16}
                   readOnly={true}
+                  showRouteStarts={true}
                 />
               </div>
             </div>
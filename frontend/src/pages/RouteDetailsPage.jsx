@@ -80,7 +80,10 @@ const RouteDetailsPage = () => {
 
     try {
       setVoteLoading(true);
-      const response = await api.voteRoute(id, voteType);
+      const response = await api.voteRoute(
+        id,
+        routeData.user_vote === voteType ? "none" : voteType
+      );
 
       setRouteData((prev) => ({
         ...prev,